@@ -0,0 +1,217 @@
+"""
+Reproducible benchmarks of the hot paths, against synthetic timetables and a local Transport API stub,
+e.g. python -m bench.run --output bench_results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import tempfile
+from datetime import datetime
+from time import perf_counter
+from typing import Callable, List
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# the settings are read at import time: point the app at the stub and a scratch database before importing it
+STUB_PORT, APP_PORT = free_port(), free_port()
+os.environ.update({
+    'TPT_APP_ID': 'bench', 'TPT_APP_KEY': 'bench', 'TPT_URL': f'http://127.0.0.1:{STUB_PORT}',
+    'DB_URL': os.environ.get('BENCH_DB_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"),
+    'PREFETCH_ENABLED': 'false', 'TPT_RATE_LIMIT': '0', 'ARCHIVE_DIR': '',
+})
+
+import httpx
+import numpy as np
+from bench.stub_server import make_stub_app, serve_in_background
+from bench.synthetic import SyntheticNetwork
+from db import SessionLocal, engine
+from settings import settings
+from train_app.etl import parse_timetable, update_timetable
+from train_app.helpers import tptdt_2_timestamp
+from train_app.interval_index import interval_index
+from train_app.repositories import IntervalRepo
+from train_app.route_finder import RouteFinder
+import train_app.models as models
+
+DATE = '2022-09-19'
+
+
+def summarize(latencies: List[float]) -> dict:
+    """
+    Summarize latencies given in seconds, in milliseconds
+    """
+    ms = np.array(latencies) * 1000
+    return {'n': len(ms), 'mean_ms': float(ms.mean()), 'p50_ms': float(np.percentile(ms, 50)),
+            'p95_ms': float(np.percentile(ms, 95)), 'p99_ms': float(np.percentile(ms, 99)), 'max_ms': float(ms.max())}
+
+
+def time_calls(fn: Callable, args_list: list) -> dict:
+    latencies = []
+    for args in args_list:
+        t = perf_counter()
+        fn(*args)
+        latencies.append(perf_counter() - t)
+    return summarize(latencies)
+
+
+def bench_parse(network: SyntheticNetwork, repeat: int) -> dict:
+    station = max(network.calls, key=lambda s: len(network.calls[s]))  # the busiest station
+    json_obj = network.timetable(station, DATE, '08:00')
+    return {'rows': len(json_obj['departures']['all']), **time_calls(parse_timetable, [(json_obj,)] * repeat)}
+
+
+def bench_update(network: SyntheticNetwork, n_windows: int) -> dict:
+    """
+    Merge overlapping windows of a day into the database, each window overlapping the previous one by half
+    """
+    station = network.stations[0]
+    args = []
+    for k in range(n_windows):
+        time_str = f'{k % 24:02d}:{30 * (k // 24) % 60:02d}'
+        ttb = parse_timetable(network.timetable(station, DATE, time_str))
+        if ttb is not None:
+            args.append((station, tptdt_2_timestamp(f'{DATE} {time_str}'), ttb))
+    db = SessionLocal()
+    try:
+        return time_calls(lambda *a: update_timetable(*a, db), args)
+    finally:
+        db.close()
+
+
+def bench_lookups(network: SyntheticNetwork, rnd: random.Random, n_lookups: int) -> dict:
+    """
+    Lookups of the interval including a time, among many disjoint intervals of every station
+    """
+    db = SessionLocal()
+    try:
+        for station in network.stations[1:]:
+            for hour in range(0, 24, 3):  # one hour windows separated by two hours gaps
+                ttb = parse_timetable(network.timetable(station, DATE, f'{hour:02d}:00', hours=1))
+                if ttb is not None:
+                    update_timetable(station, tptdt_2_timestamp(f'{DATE} {hour:02d}:00'), ttb, db, commit=False)
+        db.commit()
+        day = tptdt_2_timestamp(f'{DATE} 00:00')
+        args = [(db, rnd.choice(network.stations[1:]), day + rnd.randrange(86400)) for _ in range(n_lookups)]
+        interval_index.invalidate()
+        cold = time_calls(lambda d, s, t: (interval_index.invalidate(s), IntervalRepo.fetch_including(d, s, t)), args)
+        warm = time_calls(IntervalRepo.fetch_including, args)
+        return {'cold': cold, 'warm': warm}
+    finally:
+        db.close()
+
+
+def bench_single_route(network: SyntheticNetwork, rnd: random.Random, repeat: int) -> dict:
+    stops, _ = network.lines[0]
+    dept_ttb, target_ttb = [parse_timetable(network.timetable(s, DATE, '00:00', hours=24)) for s in stops[:2]]
+    day = tptdt_2_timestamp(f'{DATE} 00:00')
+    args = [(dept_ttb, target_ttb, stops[0], stops[1], day + rnd.randrange(86400 - 7200)) for _ in range(repeat)]
+    return {'rows': len(dept_ttb) + len(target_ttb), **time_calls(RouteFinder.find_single_route, args)}
+
+
+async def run_queries(url: str, queries: List[dict], concurrency: int) -> dict:
+    """
+    Send the queries to the /arrival_time endpoint, with at most `concurrency` requests in flight
+    """
+    semaphore, latencies, status = asyncio.Semaphore(concurrency), [], {}
+
+    async def send(client: httpx.AsyncClient, params: dict):
+        async with semaphore:
+            t = perf_counter()
+            res = await client.get(url, params=params)
+            latencies.append(perf_counter() - t)
+            status[res.status_code] = status.get(res.status_code, 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        t = perf_counter()
+        await asyncio.gather(*[send(client, params) for params in queries])
+        elapsed = perf_counter() - t
+    return {**summarize(latencies), 'requests_per_second': len(queries) / elapsed,
+            'status': {str(k): v for k, v in sorted(status.items())}}
+
+
+def bench_end_to_end(network: SyntheticNetwork, stub, rnd: random.Random, levels: List[int], n_queries: int) -> dict:
+    """
+    Cold (timetables downloaded from the stub) then warm (timetables in the database) queries, at each concurrency
+    level. Each level queries its own day, so that its cold run starts from scratch.
+    """
+    from main import app
+    server = serve_in_background(app, APP_PORT)
+    url = f'http://127.0.0.1:{APP_PORT}/arrival_time'
+    res = {}
+    try:
+        for k, level in enumerate(levels):
+            date = f'2022-10-{k + 1:02d}'
+            queries = [{'stations': ','.join(network.route(rnd, rnd.randint(2, 4))), 'date': date,
+                        'start_time': f'{rnd.randint(6, 19):02d}:{rnd.randrange(60):02d}'} for _ in range(n_queries)]
+            calls = stub.state.calls
+            cold = asyncio.run(run_queries(url, queries, level))
+            cold['api_calls'] = stub.state.calls - calls
+            warm = asyncio.run(run_queries(url, queries, level))
+            res[str(level)] = {'cold': cold, 'warm': warm}
+    finally:
+        server.stop()
+    return res
+
+
+def git_revision() -> str or None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths against synthetic timetables')
+    parser.add_argument('--output', default='bench_results.json', help='file the results are written to')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stations', type=int, default=60, help='number of stations of the synthetic network')
+    parser.add_argument('--headway', type=int, default=10, help='minutes between two trains of a line')
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated API response time, in seconds')
+    parser.add_argument('--repeat', type=int, default=200, help='repetitions of the micro benchmarks')
+    parser.add_argument('--queries', type=int, default=50, help='queries per end-to-end run')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16], help='end-to-end concurrency levels')
+    parser.add_argument('--skip-e2e', action='store_true', help='only run the micro benchmarks')
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    network = SyntheticNetwork(n_stations=args.stations, headway=args.headway, seed=args.seed)
+    models.create_tables(engine)
+    results = {
+        'parse_timetable': bench_parse(network, args.repeat),
+        'update_timetable': bench_update(network, 48),
+        'interval_lookup': bench_lookups(network, rnd, args.repeat * 5),
+        'find_single_route': bench_single_route(network, rnd, args.repeat),
+    }
+    if not args.skip_e2e:
+        stub = make_stub_app(network, args.latency)
+        stub_server = serve_in_background(stub, STUB_PORT)
+        try:
+            results['arrival_time'] = bench_end_to_end(network, stub, rnd, args.concurrency, args.queries)
+        finally:
+            stub_server.stop()
+
+    report = {
+        'meta': {'time': datetime.now().isoformat(timespec='seconds'), 'revision': git_revision(),
+                 'python': platform.python_version(), 'platform': platform.platform(), 'db_url': settings.db_url,
+                 'args': vars(args)},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
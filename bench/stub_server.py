@@ -0,0 +1,74 @@
+"""
+Local stub of the Transport API timetable endpoint, e.g. python -m bench.stub_server --port 9100
+"""
+import argparse
+import asyncio
+import threading
+import time
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+from bench.synthetic import SyntheticNetwork
+
+
+def make_stub_app(network: SyntheticNetwork, latency: float = 0.) -> FastAPI:
+    """
+    Make an app serving {station}/timetable.json like the Transport API, use it with TPT_URL=http://host:port
+    :param network: the network to serve
+    :param latency: simulated response time of the API, in seconds
+    :return: the app, whose state.calls counts the API calls. The (status code, headers) appended to state.failures
+    are answered to the next calls instead of the timetable, e.g. (429, {'Retry-After': '2'}) to test the retries
+    """
+    app = FastAPI()
+    app.state.calls = 0
+    app.state.failures = []
+
+    @app.get('/{station}/timetable.json')
+    async def timetable(station: str, date: str, time: str, app_id: str = '', app_key: str = ''):
+        app.state.calls += 1
+        if latency:
+            await asyncio.sleep(latency)
+        if app.state.failures:
+            status_code, headers = app.state.failures.pop(0)
+            return JSONResponse({'error': 'Simulated failure'}, status_code=status_code, headers=headers)
+        if station not in network.calls:
+            raise HTTPException(status_code=404, detail='Station not found')
+        return network.timetable(station, date, time)
+
+    return app
+
+
+class BackgroundServer(uvicorn.Server):
+    """
+    uvicorn server running in a daemon thread
+    """
+    def install_signal_handlers(self):
+        pass
+
+    def start(self) -> 'BackgroundServer':
+        threading.Thread(target=self.run, daemon=True).start()
+        while not self.started:
+            time.sleep(0.01)
+        return self
+
+    def stop(self):
+        self.should_exit = True
+
+
+def serve_in_background(app, port: int) -> BackgroundServer:
+    return BackgroundServer(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning')).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve synthetic timetables like the Transport API')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated API response time, in seconds')
+    parser.add_argument('--stations', type=int, default=60)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    app = make_stub_app(SyntheticNetwork(n_stations=args.stations, seed=args.seed), args.latency)
+    uvicorn.run(app, host='127.0.0.1', port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Synthetic rail network and Transport API style timetables for benchmarks
+"""
+import random
+from datetime import datetime, timedelta
+from string import ascii_uppercase
+from typing import Dict, List
+
+
+def station_code(i: int) -> str:
+    """
+    Return a 3-letter station code, e.g. 0 -> 'AAA'
+    """
+    return ''.join(ascii_uppercase[i // 26 ** k % 26] for k in (2, 1, 0))
+
+
+class SyntheticNetwork:
+    """
+    A network of lines, each served in both directions by trains at a fixed headway all day long
+    """
+    def __init__(self, n_stations: int = 60, n_lines: int = 8, stops_per_line: int = 12, headway: int = 10,
+                 seed: int = 0):
+        """
+        :param n_stations: number of stations
+        :param n_lines: number of lines
+        :param stops_per_line: number of stations served by a line
+        :param headway: minutes between two trains of a line in the same direction
+        :param seed: random seed, the network is fully determined by the parameters
+        """
+        rnd = random.Random(seed)
+        self.stations = [station_code(i) for i in range(n_stations)]
+        self.headway = headway
+        self.lines = []  # (stations, minutes from the first station to each station)
+        for _ in range(n_lines):
+            stops = rnd.sample(self.stations, stops_per_line)
+            offsets = [0]
+            for _ in stops[1:]:
+                offsets.append(offsets[-1] + rnd.randint(2, 8))
+            self.lines.append((stops, offsets))
+        self.calls = {}  # station -> [(line, direction, index of the stop)]
+        for line, (stops, _) in enumerate(self.lines):
+            for direction in (0, 1):
+                for k, station in enumerate(stops if direction == 0 else stops[::-1]):
+                    self.calls.setdefault(station, []).append((line, direction, k))
+
+    def route(self, rnd: random.Random, n_stations: int) -> List[str]:
+        """
+        Return a random route of consecutive stations of a line, so that it can always be travelled
+        """
+        stops, _ = self.lines[rnd.randrange(len(self.lines))]
+        stops = stops if rnd.random() < 0.5 else stops[::-1]
+        i = rnd.randrange(len(stops) - n_stations + 1)
+        return stops[i:i + n_stations]
+
+    def departures(self, station: str, date: str, time: str, hours: int = 2) -> List[Dict]:
+        """
+        Return the departures of a station in the Transport API format, from the given time and within a few hours
+        """
+        day = datetime.strptime(date, '%Y-%m-%d')
+        t0 = datetime.strptime(f'{date} {time}', '%Y-%m-%d %H:%M')
+        t1 = t0 + timedelta(hours=hours)
+        res = []
+        for line, direction, k in self.calls.get(station, []):
+            stops, offsets = self.lines[line]
+            offsets = offsets if direction == 0 else [offsets[-1] - o for o in offsets[::-1]]
+            for trip in range(24 * 60 // self.headway):
+                arrival = day + timedelta(minutes=trip * self.headway + direction * 3 + offsets[k])
+                departure = arrival + timedelta(minutes=1)
+                first, last = k == 0, k == len(stops) - 1
+                event = arrival if last else departure
+                if not t0 <= event < t1:
+                    continue
+                res.append({
+                    'aimed_departure_time': None if last else departure.strftime('%H:%M'),
+                    'aimed_arrival_time': None if first else arrival.strftime('%H:%M'),
+                    'service': str(24000000 + line),
+                    'train_uid': f'L{line:02d}{direction}{trip:04d}',
+                })
+        res.sort(key=lambda d: d['aimed_departure_time'] or d['aimed_arrival_time'])
+        return res
+
+    def timetable(self, station: str, date: str, time: str, hours: int = 2) -> Dict:
+        """
+        Return a /station/{code}/timetable.json response
+        """
+        return {'date': date, 'time_of_day': time, 'station_code': station,
+                'departures': {'all': self.departures(station, date, time, hours)}}
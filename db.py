@@ -3,7 +3,12 @@
 # @Time    : 2022/7/30 10:48
 # @Author  : liyun
 # @desc    :
-from sqlalchemy import create_engine
+from asyncio import get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial
+from typing import Any, Callable
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import pytz
@@ -15,13 +20,55 @@ SQLALCHEMY_DATABASE_URL = settings.db_url
 
 
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}, echo=True
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}, echo=settings.db_echo
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
 
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_conn, connection_record):
+    """
+    Let readers run while a writer commits (WAL), and make a writer wait for the lock instead of failing
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")  # safe with WAL, only the last commits may be lost on power failure
+    cursor.execute("PRAGMA busy_timeout=10000")
+    cursor.execute("PRAGMA cache_size=-65536")  # 64MB
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+# db work of the async endpoints runs in threads, so that queries do not block the event loop. Writes go through a
+# single thread: they are serialized as when they ran on the event loop, and never wait for each other's locks.
+db_readers = ThreadPoolExecutor(max_workers=settings.db_threads, thread_name_prefix="db-read")
+db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+
+
+def call_with_session(fn: Callable, *args, **kwargs) -> Any:
+    db = SessionLocal()
+    try:
+        return fn(db, *args, **kwargs)
+    finally:
+        db.close()
+
+
+async def run_in_session(fn: Callable, *args, write: bool = False, **kwargs) -> Any:
+    """
+    Run fn(db, *args, **kwargs) in a db thread, with a session of its own
+    :param fn: the function, taking the session as first argument
+    :param write: whether fn writes to the db, and must run in the writer thread
+    :return: the result of fn
+    """
+    call = partial(call_with_session, fn, *args, **kwargs)
+    # the context is copied, for the metrics of the request
+    return await get_running_loop().run_in_executor(db_writer if write else db_readers, copy_context().run, call)
+
+
 # Dependency
 def get_db():
     db = SessionLocal()
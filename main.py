@@ -3,13 +3,24 @@
 # @Time    : 2022/7/30 10:42
 # @Author  : liyun
 # @desc    :
+import json
+from time import perf_counter
+from typing import List
+import httpx
 import uvicorn
-from fastapi import Depends, FastAPI
-from sqlalchemy.orm import Session
-from datetime import datetime
-from train_app.schemas import Journey
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from train_app.cache import journey_cache, timetable_cache
+from train_app.helpers import timestamp_2_tptdt, tptdt_2_timestamp
+from train_app.maintenance import maintenance_job
+from train_app.metrics import metrics, request_timings, server_timing
+from train_app.prefetch import prefetch_scheduler
+from train_app.route_finder import RouteFinder
+from train_app.schemas import ArrivalProfilePoint, ArrivalQuery, ArrivalResult, Journey, SingleJourney
+from train_app.shared import shared_state
+from train_app.transport_api import tpt_client
 import train_app.models as models
-from db import get_db, engine
+from db import engine
 from settings import settings
 
 
@@ -17,17 +28,182 @@ app = FastAPI(title="Timetable FastAPI Application",
               description="FastAPI Application that finds the arrival time of a route given a start time",
               version="1.0.0", )
 
-models.Base.metadata.create_all(bind=engine)
+models.create_tables(engine)
+metrics.instrument_engine(engine)
+metrics.register_gauge('timetable_cache', lambda: {k: v for k, v in timetable_cache.stats().items() if k != 'ttl'})
+metrics.register_gauge('journey_cache', lambda: {k: v for k, v in journey_cache.stats().items() if k != 'ttl'})
+metrics.register_gauge('tpt_api', tpt_client.stats.summary)
+metrics.register_gauge('prefetch', lambda: {k: v for k, v in prefetch_scheduler.stats().items() if k != 'hot_stations'})
+
+
+@app.on_event("startup")
+async def start_background_jobs():
+    if settings.prefetch_enabled:
+        prefetch_scheduler.start()
+    if settings.maintenance_interval > 0:
+        maintenance_job.start()
+    if settings.connection_index:  # e.g. switched on for a database of timetables saved without it
+        maintenance_job.start_backfill()
+
+
+@app.on_event("shutdown")
+async def close_tpt_client():
+    await prefetch_scheduler.stop()
+    await maintenance_job.stop()
+    await tpt_client.aclose()
+
+
+@app.middleware("http")
+async def add_server_timing(request: Request, call_next):
+    """
+    Report the time spent per stage by the request in the Server-Timing header
+    """
+    if not metrics.enabled:
+        return await call_next(request)
+    timings = {}
+    token = request_timings.set(timings)
+    t = perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        request_timings.reset(token)
+    total = perf_counter() - t
+    metrics.observe('request', total)
+    response.headers['Server-Timing'] = server_timing({**timings, 'total': [total, 1]})
+    return response
+
+
+def make_journey(routes: List[SingleJourney]) -> Journey:
+    """
+    Format the routes found into the journey returned to the user
+    :param routes: the routes from the start to the end station
+    :return: the journey, whose summary is the arrival time
+    """
+    outputs = [{**r.dict(include={'train_uid', 'departure_station', 'destination_station'}),
+                'departure_time': timestamp_2_tptdt(r.departure_timestamp),
+                'arrival_time': timestamp_2_tptdt(r.arrival_timestamp)} for r in routes]
+    return Journey.parse_obj({'summary': outputs[-1]['arrival_time'][-5:], 'routes': outputs})
+
+
+def parse_query(stations: List[str], date: str, start_time: str, max_waiting: int or None) -> (List[str], int, int):
+    """
+    Validate a query and convert it into the arguments of RouteFinder.search_routes
+    """
+    station_list = [s.strip().upper() for s in stations if s.strip()]
+    if len(station_list) < 2:
+        raise ValueError('At least two stations are required')
+    start_timestamp = tptdt_2_timestamp(f'{date} {start_time}')
+    max_waiting = settings.ub_max_waiting if max_waiting is None else min(max_waiting, settings.ub_max_waiting)
+    return station_list, start_timestamp, max_waiting
+
+
+def error_message(e: Exception) -> str:
+    """
+    Describe an error to the user, without leaking the API credentials in request urls
+    """
+    if isinstance(e, httpx.HTTPStatusError):
+        return f'Transport API returned {e.response.status_code}'
+    if isinstance(e, httpx.HTTPError):
+        return f'Transport API unavailable: {type(e).__name__}'
+    return str(e) or type(e).__name__
 
 
 @app.get('/arrival_time', response_model=Journey)
-def get_arrival_time(stations: str, date: str, start_time: str, db: Session = Depends(get_db)):
+async def get_arrival_time(stations: str, date: str, start_time: str, max_waiting: int = None):
     """
     Return arrival time of a route
     """
-    station_list = [s.strip() for s in stations.split(',')]
-    start_timestamp = datetime.strptime(f'{date} {start_time}', '%Y-%m-%d %H:%M').timestamp()
-    return {'summary': '13.25'}
+    try:
+        query = parse_query(stations.split(','), date, start_time, max_waiting)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    prefetch_scheduler.record(query[0])
+    for station in query[0]:
+        shared_state.sync(station)  # drop the cached journeys made stale by other workers
+    journey = journey_cache.get_journey(*query)
+    if journey is not None:
+        return journey
+    try:
+        routes = await RouteFinder().search_routes(*query)
+    except (ValueError, NotImplementedError) as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except (RuntimeError, httpx.HTTPError) as e:
+        raise HTTPException(status_code=502, detail=error_message(e))
+    journey = make_journey(routes)
+    journey_cache.put_journey(*query, routes[0].departure_timestamp, journey)
+    return journey
+
+
+@app.post('/arrival_time/batch', response_model=List[ArrivalResult])
+async def get_arrival_times(queries: List[ArrivalQuery]):
+    """
+    Return arrival times of many routes, in input order. The timetables are loaded once for all routes.
+    """
+    parsed, res = [], [ArrivalResult() for _ in queries]
+    for i, q in enumerate(queries):
+        try:
+            query = parse_query(q.stations, q.date, q.start_time, q.max_waiting)
+        except ValueError as e:
+            res[i].error = str(e)
+            continue
+        prefetch_scheduler.record(query[0])
+        for station in query[0]:
+            shared_state.sync(station)
+        res[i].journey = journey_cache.get_journey(*query)
+        if res[i].journey is None:
+            parsed.append((i, query))
+    found = await RouteFinder().search_batch([query for _, query in parsed])
+    for (i, query), routes in zip(parsed, found):
+        if isinstance(routes, Exception):
+            res[i].error = error_message(routes)
+        else:
+            res[i].journey = make_journey(routes)
+            journey_cache.put_journey(*query, routes[0].departure_timestamp, res[i].journey)
+    return res
+
+
+@app.get('/arrival_profile')
+async def get_arrival_profile(stations: str, date: str, start_time: str, end_time: str, step: int = None,
+                              max_waiting: int = None):
+    """
+    Return the arrival times of a route for all start times between start_time and end_time, every `step` minutes,
+    or by default for every departure from the first station that leads to a better arrival than the next ones.
+    The results are streamed as newline-delimited json, one time window at a time.
+    """
+    try:
+        query = parse_query(stations.split(','), date, start_time, max_waiting)
+        t_to = tptdt_2_timestamp(f'{date} {end_time}')
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if t_to < query[1]:
+        raise HTTPException(status_code=422, detail='end_time is before start_time')
+    if step is not None and step <= 0:
+        raise HTTPException(status_code=422, detail='step must be positive')
+    prefetch_scheduler.record(query[0])
+    for station in query[0]:
+        shared_state.sync(station)
+
+    async def lines():
+        try:
+            async for chunk in RouteFinder().search_profile(*query[:2], t_to, query[2],
+                                                            None if step is None else step * 60):
+                points = [ArrivalProfilePoint(start_time=timestamp_2_tptdt(t),
+                                              **({'error': error_message(routes)} if isinstance(routes, Exception)
+                                                 else {'journey': make_journey(routes)}))
+                          for t, routes in chunk]
+                yield ''.join(f'{p.json()}\n' for p in points)
+        except Exception as e:  # the response has started, report the error as the last line
+            yield json.dumps({'error': error_message(e)}) + '\n'
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Return the stage latencies and counters in the Prometheus text format
+    """
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
 
 
 if __name__ == "__main__":
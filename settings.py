@@ -16,13 +16,49 @@ class Settings(BaseSettings):
     db_url: str = Field("sqlite:///./train.db", env="DB_URL")
     ub_max_waiting: int = Field(180, env="UB_MAX_WAITING")  # upper boundary of max waiting, in minutes
     max_single_journey: int = Field(3600*4, env="MAX_SINGLE_JOURNEY")  # longest single journey to consider, in seconds
-    t_window: int = Field(2, env="T_WINDOW")  # time window of a single downloaded timetable
+    t_window: int = Field(2, env="T_WINDOW")  # time window of a single downloaded timetable, in hours
     download_concurrency: int = Field(3, env="DOWNLOAD_CONCURRENCY")  # how many API calls are run when downloading
+    tpt_max_connections: int = Field(10, env="TPT_MAX_CONNECTIONS")  # size of the connection pool to the API
+    tpt_timeout: float = Field(10, env="TPT_TIMEOUT")  # timeout of a single API call, in seconds
+    tpt_rate_limit: float = Field(5, env="TPT_RATE_LIMIT")  # max API calls per second, 0 means unlimited
+    tpt_burst: int = Field(10, env="TPT_BURST")  # max API calls made in a burst
+    tpt_max_retries: int = Field(3, env="TPT_MAX_RETRIES")  # retries of a throttled (429) or failed (5xx) call
+    tpt_retry_backoff: float = Field(0.5, env="TPT_RETRY_BACKOFF")  # base of the exponential backoff, in seconds
+    route_engine: str = Field("merge", env="ROUTE_ENGINE")  # 'merge' (leg-by-leg join), 'csa' (connection scan)
+    # or 'index' (leg-by-leg lookups of the connection index)
+    connection_index: bool = Field(False, env="CONNECTION_INDEX")  # index the connections between stations on update,
+    # always on with ROUTE_ENGINE=index
+    prefetch_concurrency: int = Field(4, env="PREFETCH_CONCURRENCY")  # stations loaded concurrently for a search
+    prefetch_enabled: bool = Field(True, env="PREFETCH_ENABLED")  # prefetch popular stations in the background
+    prefetch_calls_per_minute: float = Field(30, env="PREFETCH_CALLS_PER_MINUTE")  # API budget of the prefetch
+    prefetch_queue_size: int = Field(100, env="PREFETCH_QUEUE_SIZE")  # max windows waiting to be prefetched
+    prefetch_top_n: int = Field(20, env="PREFETCH_TOP_N")  # number of the most queried stations to keep loaded
+    prefetch_lookahead: int = Field(4, env="PREFETCH_LOOKAHEAD")  # how far ahead to keep loaded, in hours
+    prefetch_interval: int = Field(60, env="PREFETCH_INTERVAL")  # how often to plan the prefetch, in seconds
+    prefetch_half_life: int = Field(1800, env="PREFETCH_HALF_LIFE")  # half life of the station popularity, in seconds
+    single_flight_window: int = Field(900, env="SINGLE_FLIGHT_WINDOW")  # coalesce downloads starting in a window (s)
+    archive_dir: str = Field("", env="ARCHIVE_DIR")  # if set, raw API responses are also saved in this folder
+    ttb_cache_size: int = Field(256, env="TTB_CACHE_SIZE")  # max number of station timetables cached in memory
+    ttb_cache_ttl: int = Field(600, env="TTB_CACHE_TTL")  # time to live of a cached timetable, in seconds
+    timetable_backend: str = Field("sql", env="TIMETABLE_BACKEND")  # where records are stored, 'sql' or 'arrow'
+    arrow_dir: str = Field("./timetables", env="ARROW_DIR")  # folder of the arrow backend files
+    retention_days: float = Field(2, env="RETENTION_DAYS")  # past days of timetables kept by the maintenance
+    merge_gap: int = Field(60, env="MERGE_GAP")  # intervals at most this far apart are merged by the maintenance (s)
+    maintenance_interval: float = Field(6, env="MAINTENANCE_INTERVAL")  # hours between two maintenances, 0 disables
+    shared_dir: str = Field("", env="SHARED_DIR")  # folder shared by the workers of a host, e.g. /dev/shm/train_app
+    db_threads: int = Field(8, env="DB_THREADS")  # threads running the db reads of the async endpoints
+    journey_cache_size: int = Field(4096, env="JOURNEY_CACHE_SIZE")  # max number of journeys cached in memory
+    journey_cache_ttl: int = Field(600, env="JOURNEY_CACHE_TTL")  # time to live of a cached journey, in seconds
+    journey_cache_bucket: int = Field(900, env="JOURNEY_CACHE_BUCKET")  # start times sharing a cache entry, in seconds
+    metrics_enabled: bool = Field(True, env="METRICS_ENABLED")  # record stage latencies, exported on /metrics
+    db_echo: bool = Field(False, env="DB_ECHO")  # log every SQL statement, for debugging only
 
     class Config:
         env_file = '.env'  # variables in this file have higher priorities
 
 
 settings = Settings()
+if settings.route_engine == 'index':  # the only engine reading the connection index
+    settings.connection_index = True
 if not settings.tpt_app_id or not settings.tpt_app_key:
     raise ValueError('Key and/or app id for transport api are/is missing.')
@@ -0,0 +1,60 @@
+"""
+Test fixtures. The settings are read at import time, so the environment is set before importing the app
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.update({
+    'TPT_APP_ID': 'test', 'TPT_APP_KEY': 'test', 'TPT_URL': 'http://tpt.test', 'TPT_RATE_LIMIT': '0',
+    'DB_URL': f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}", 'TIMETABLE_BACKEND': 'sql',
+    'ARCHIVE_DIR': '', 'SHARED_DIR': '', 'PREFETCH_ENABLED': 'false', 'MAINTENANCE_INTERVAL': '0',
+})
+
+import httpx
+import pytest
+from bench.stub_server import make_stub_app
+from db import SessionLocal, engine
+from train_app.cache import journey_cache, timetable_cache
+from train_app.interval_index import interval_index
+from train_app.transport_api import tpt_client
+import train_app.models as models
+
+
+def empty_db():
+    """
+    Delete all rows, and drop what the process cached of them
+    """
+    with engine.begin() as conn:
+        for table in reversed(models.Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    interval_index.invalidate()
+    timetable_cache.clear()
+    journey_cache.clear()
+
+
+@pytest.fixture
+def db():
+    """
+    A session of an empty database
+    """
+    models.Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    yield session
+    session.close()
+    empty_db()
+
+
+@pytest.fixture
+def serve_api(monkeypatch):
+    """
+    Serve the Transport API from a network in-process, see bench.stub_server
+    :return: a function taking the network, and returning the stub app whose state.calls counts the API calls
+    """
+    def serve(network):
+        app = make_stub_app(network)
+        monkeypatch.setattr(tpt_client, 'transport', httpx.ASGITransport(app=app))
+        monkeypatch.setattr(tpt_client, '_client', None)
+        return app
+    return serve
@@ -0,0 +1,163 @@
+"""
+The connection scan engine against the leg by leg merge engine
+"""
+import asyncio
+import random
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+import numpy as np
+import pytest
+from bench.synthetic import SyntheticNetwork
+from settings import settings
+from train_app.csa import suffix_best
+from train_app.helpers import tptdt_2_timestamp
+from train_app.maintenance import backfill_connections
+from train_app.route_finder import RouteFinder
+from tests.conftest import empty_db
+
+DATE = '2022-09-19'
+
+
+class FixedNetwork:
+    """
+    Trains given by their stops, as (station, arrival, departure) with times in hh:mm on DATE, served like
+    bench.synthetic.SyntheticNetwork
+    """
+    def __init__(self, trains: Dict[str, List[Tuple[str, str or None, str or None]]]):
+        self.trains = trains
+        self.calls = {station for stops in trains.values() for station, _, _ in stops}
+
+    def timetable(self, station: str, date: str, time: str, hours: int = settings.t_window) -> dict:
+        t0 = datetime.strptime(f'{date} {time}', '%Y-%m-%d %H:%M')
+        departures = []
+        for uid, stops in self.trains.items():
+            for stop, arrival, departure in stops:
+                event = datetime.strptime(f'{DATE} {departure or arrival}', '%Y-%m-%d %H:%M')
+                if stop == station and t0 <= event < t0 + timedelta(hours=hours):
+                    departures.append({'aimed_departure_time': departure, 'aimed_arrival_time': arrival,
+                                       'service': '24000000', 'train_uid': uid})
+        return {'date': date, 'time_of_day': time, 'departures': {'all': departures}}
+
+
+def search(stations: List[str], start_time: str, max_waiting: int, engine: str):
+    """
+    Search a route with an engine
+    :return: the legs found, or the type of the exception raised
+    """
+    try:
+        routes = asyncio.run(RouteFinder().search_routes(stations, tptdt_2_timestamp(f'{DATE} {start_time}'),
+                                                         max_waiting, engine=engine))
+    except (ValueError, NotImplementedError) as e:
+        return type(e)
+    return [(r.train_uid, r.departure_station, r.destination_station, r.departure_timestamp, r.arrival_timestamp)
+            for r in routes]
+
+
+def compare(stations: List[str], start_time: str, max_waiting: int, engines: Tuple[str, str] = ('merge', 'csa')):
+    """
+    Search a route with two engines, starting from an empty database each time
+    :return: the result of the first engine, after checking the second one found the same
+    """
+    res = []
+    for engine in engines:
+        empty_db()  # each engine downloads and extends the timetables it needs
+        res.append(search(stations, start_time, max_waiting, engine))
+    assert res[0] == res[1]
+    return res[0]
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_synthetic_routes(db, serve_api, seed):
+    network = SyntheticNetwork(n_stations=20, n_lines=4, stops_per_line=6, seed=seed)
+    serve_api(network)
+    rnd = random.Random(seed)
+    for _ in range(20):
+        stations = network.route(rnd, rnd.randint(2, 4))
+        res = compare(stations, f'{rnd.randint(5, 20):02d}:{rnd.randrange(60):02d}', 60)
+        assert isinstance(res, list) and len(res) == len(stations) - 1
+
+
+@pytest.mark.parametrize('seed', range(2))
+def test_index_engine(db, serve_api, monkeypatch, seed):
+    monkeypatch.setattr(settings, 'connection_index', True)
+    network = SyntheticNetwork(n_stations=20, n_lines=4, stops_per_line=6, seed=seed)
+    serve_api(network)
+    rnd = random.Random(seed)
+    for _ in range(10):
+        stations = network.route(rnd, rnd.randint(2, 4))
+        res = compare(stations, f'{rnd.randint(5, 20):02d}:{rnd.randrange(60):02d}', 60, engines=('merge', 'index'))
+        assert isinstance(res, list) and len(res) == len(stations) - 1
+
+
+def test_connection_backfill(db, serve_api, monkeypatch):
+    # timetables saved while the index was off are indexed by the backfill, without downloading them again
+    network = SyntheticNetwork(n_stations=20, n_lines=4, stops_per_line=6, seed=0)
+    api = serve_api(network)
+    rnd = random.Random(0)
+    routes = [(network.route(rnd, rnd.randint(2, 4)), f'{rnd.randint(5, 20):02d}:{rnd.randrange(60):02d}')
+              for _ in range(5)]
+    expected = [search(stations, start_time, 60, 'merge') for stations, start_time in routes]
+    monkeypatch.setattr(settings, 'connection_index', True)
+    calls = api.state.calls
+    assert backfill_connections(db) > 0
+    assert backfill_connections(db) == 0
+    assert [search(stations, start_time, 60, 'index') for stations, start_time in routes] == expected
+    assert api.state.calls == calls
+
+
+def test_faster_later_train(db, serve_api):
+    serve_api(FixedNetwork({
+        'SLOW': [('AAA', None, '08:05'), ('AAB', '09:30', '09:31'), ('AAC', '10:00', None)],
+        'FAST': [('AAA', None, '08:20'), ('AAB', '08:50', '08:51'), ('AAC', '09:20', None)],
+    }))
+    res = compare(['AAA', 'AAB', 'AAC'], '08:00', 60)
+    assert [leg[0] for leg in res] == ['FAST', 'FAST']
+
+
+def test_connection_on_the_next_leg(db, serve_api):
+    serve_api(FixedNetwork({
+        'T1': [('AAA', None, '08:05'), ('AAB', '08:30', None)],
+        'T2': [('AAB', None, '08:25'), ('AAC', '08:40', None)],  # leaves before T1 arrives
+        'T3': [('AAB', None, '08:45'), ('AAC', '09:00', None)],
+    }))
+    assert [leg[0] for leg in compare(['AAA', 'AAB', 'AAC'], '08:00', 60)] == ['T1', 'T3']
+
+
+def test_spill_over(db, serve_api):
+    # the arrival is past the timetables downloaded from the start time, which are extended
+    span = settings.download_concurrency * settings.t_window
+    departure, arrival = f'{7 + span:02d}:50', f'{8 + span:02d}:20'
+    api = serve_api(FixedNetwork({
+        'T0': [('AAC', None, '08:30'), ('AAB', '09:00', None)],
+        'T1': [('AAA', None, departure), ('AAB', arrival, None)],
+    }))
+    res = compare(['AAA', 'AAB'], '08:00', span * 60)
+    assert res == [('T1', 'AAA', 'AAB', tptdt_2_timestamp(f'{DATE} {departure}'),
+                    tptdt_2_timestamp(f'{DATE} {arrival}'))]
+    assert api.state.calls > 2 * 2 * settings.download_concurrency  # two stations, twice, and the extensions
+
+
+def test_wait_too_long(db, serve_api):
+    serve_api(FixedNetwork({
+        'T1': [('AAA', None, '08:05'), ('AAB', '08:30', None)],
+        'T2': [('AAB', None, '10:00'), ('AAC', '10:20', None)],
+    }))
+    assert compare(['AAA', 'AAB', 'AAC'], '08:00', 60) is ValueError
+    assert [leg[0] for leg in compare(['AAA', 'AAB', 'AAC'], '08:00', 120)] == ['T1', 'T2']
+
+
+def test_no_route(db, serve_api):
+    serve_api(FixedNetwork({
+        'T1': [('AAA', None, '08:05'), ('AAB', '08:30', None)],
+        'T2': [('AAC', None, '08:05'), ('AAB', '08:30', None)],
+    }))
+    assert compare(['AAA', 'AAC'], '08:00', 60) is NotImplementedError
+
+
+@pytest.mark.parametrize('t0', [tptdt_2_timestamp(f'{DATE} 00:00'), 2 ** 31 - 600])  # before and across 2**31
+def test_suffix_best(t0):
+    arrival = t0 + np.random.default_rng(0).integers(0, 20, 200) * 60
+    # the first connection arriving the earliest among each connection and the following ones
+    expected = [i + int(np.argmin(arrival[i:])) for i in range(len(arrival))]
+    assert suffix_best(arrival).tolist() == expected
+    assert len(suffix_best(arrival[:0])) == 0
@@ -0,0 +1,58 @@
+"""
+Loading consecutive windows of timetables
+"""
+import asyncio
+import pytest
+from bench.synthetic import SyntheticNetwork
+from db import SessionLocal
+from settings import settings
+from train_app.etl import load_timetable
+from train_app.helpers import tptdt_2_timestamp
+from train_app.repositories import IntervalRepo
+from train_app.route_finder import RouteFinder
+from train_app.transport_api import window_datetimes, window_starts
+
+T0 = tptdt_2_timestamp('2022-09-19 08:00')
+SPAN = settings.download_concurrency * settings.t_window * 3600  # reach of a single load
+
+
+def station_intervals(station: str) -> list:
+    with SessionLocal() as db:
+        return [itl[:2] for itl in IntervalRepo.fetch_index(db, station).items]
+
+
+@pytest.mark.parametrize('headway', [1, 10])
+def test_routes_across_consecutive_windows(db, serve_api, headway):
+    network = SyntheticNetwork(n_stations=20, n_lines=4, stops_per_line=6, headway=headway, seed=0)
+    api = serve_api(network)
+    stations = network.lines[0][0][:2]
+    for t in (T0, T0 + SPAN):
+        for station in stations:
+            asyncio.run(load_timetable(station, t))
+    if headway == 1:  # the last event of a window is a minute before the next window starts
+        assert all(len(station_intervals(station)) == 1 for station in stations)
+    calls = api.state.calls
+    for minutes in range(1, 11):  # the route spills over the boundary of the windows first loaded
+        routes = asyncio.run(RouteFinder().search_routes(stations, T0 + SPAN - minutes * 60, 60, engine='merge'))
+        assert len(routes) == 1 and routes[0].departure_timestamp >= T0 + SPAN - minutes * 60
+    if headway == 1:
+        assert api.state.calls == calls
+
+
+def test_touching_intervals_are_merged_on_load(db, serve_api, monkeypatch):
+    network = SyntheticNetwork(n_stations=20, n_lines=4, stops_per_line=6, headway=1, seed=0)
+    api = serve_api(network)
+    station = network.lines[0][0][0]
+    with monkeypatch.context() as patch:
+        patch.setattr(settings, 'merge_gap', 0)  # loads the windows as separate intervals, like before they were merged
+        for t in (T0, T0 + SPAN):
+            asyncio.run(load_timetable(station, t))
+    assert len(station_intervals(station)) == 2
+    calls = api.state.calls
+    asyncio.run(load_timetable(station, T0 + SPAN - 600))  # nothing to download, the intervals are a minute apart
+    assert len(station_intervals(station)) == 1 and api.state.calls == calls
+
+
+def test_window_datetimes():
+    assert [int(dt.timestamp()) for dt in window_datetimes(T0)] == window_starts(T0)
+    assert window_datetimes(T0, []) == []  # nothing to download
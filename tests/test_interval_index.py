@@ -0,0 +1,120 @@
+"""
+The interval index only shares committed intervals, and follows the changes of other processes
+"""
+import os
+import subprocess
+import sys
+from sqlalchemy import text
+from db import SessionLocal, engine
+from settings import settings
+from train_app.cache import timetable_cache
+from train_app.columnar import ColumnarTimetable
+from train_app.etl import update_timetable
+from train_app.interval_index import StationIntervals
+from train_app.metrics import metrics
+from train_app.repositories import IntervalRepo
+from train_app.route_finder import RouteFinder
+
+T0 = 1663570800  # 2022-09-19 08:00
+
+
+def timetable(*minutes: int) -> ColumnarTimetable:
+    return ColumnarTimetable.from_columns([T0 + m * 60 for m in minutes], [T0 + m * 60 - 60 for m in minutes],
+                                          [1] * len(minutes), [f'T{m:04d}' for m in minutes])
+
+
+def test_uncommitted_intervals_are_private(db):
+    update_timetable('AAA', T0, timetable(0, 10, 20), db, commit=False)
+    assert IntervalRepo.fetch_including(db, 'AAA', T0 + 600) is not None  # the session sees its own changes
+    other = SessionLocal()
+    try:
+        assert IntervalRepo.fetch_index(other, 'AAA').including(T0 + 600) is None
+        db.commit()
+        assert IntervalRepo.fetch_including(other, 'AAA', T0 + 600) is not None
+    finally:
+        other.close()
+
+
+def test_rolled_back_intervals_are_dropped(db):
+    update_timetable('AAA', T0, timetable(0, 10), db)
+    update_timetable('AAA', T0 + 300, timetable(5, 40), db, commit=False)  # merged with the first interval
+    assert IntervalRepo.fetch_including(db, 'AAA', T0 + 2400) is not None
+    db.rollback()
+    assert IntervalRepo.fetch_including(db, 'AAA', T0 + 2400) is None
+    interval = IntervalRepo.fetch_including(db, 'AAA', T0 + 600)
+    assert (interval.start_timestamp, interval.stop_timestamp) == (T0, T0 + 600)
+
+
+def test_batched_updates_are_merged(db):
+    for k in range(5):  # overlapping windows in a single transaction, like the bulk ingest
+        update_timetable('AAA', T0 + k * 1800, timetable(*range(k * 30, k * 30 + 40, 10)), db, commit=False)
+    db.commit()
+    items = IntervalRepo.fetch_index(db, 'AAA').items
+    assert [(start, stop) for start, stop, _ in items] == [(T0, T0 + 150 * 60)]
+
+
+def test_updates_do_not_change_what_readers_hold():
+    intervals = StationIntervals([(T0, T0 + 600, 1), (T0 + 1200, T0 + 1800, 2)])
+    items = intervals.items
+    intervals.add(T0 + 2400, T0 + 3000, 3)
+    intervals.remove([1])
+    assert items == [(T0, T0 + 600, 1), (T0 + 1200, T0 + 1800, 2)]
+    assert intervals.items == [(T0 + 1200, T0 + 1800, 2), (T0 + 2400, T0 + 3000, 3)]
+    assert intervals.including(T0 + 300) is None and intervals.including(T0 + 2700) == 3
+    assert intervals.included(T0, T0 + 3000) == [2, 3]
+
+
+def fetch_including(station: str, val: int) -> tuple or None:
+    """
+    Look up an interval in a new session, like a request does
+    """
+    with SessionLocal() as db:
+        interval = IntervalRepo.fetch_including(db, station, val)
+        return None if interval is None else (interval.start_timestamp, interval.stop_timestamp)
+
+
+def test_changes_of_other_processes_are_seen(db, monkeypatch):
+    monkeypatch.setattr(settings, 'merge_gap', 0)  # two intervals a minute apart
+    update_timetable('AAA', T0, timetable(0, 10, 20), db)
+    update_timetable('AAA', T0 + 1260, timetable(21, 30), db)
+    assert fetch_including('AAA', T0 + 600) == (T0, T0 + 1200)  # indexed
+    subprocess.run([sys.executable, '-m', 'train_app.maintenance', '--retention-days', '100000', '--no-vacuum'],
+                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), check=True)
+    assert fetch_including('AAA', T0 + 600) == (T0, T0 + 1800)  # merged by the maintenance
+
+
+def test_deleted_intervals_are_reloaded(db):
+    update_timetable('AAA', T0, timetable(0, 10, 20), db)
+    assert fetch_including('AAA', T0 + 600) == (T0, T0 + 1200)
+    with engine.begin() as conn:  # an interval replaced without bumping the version of the station
+        conn.execute(text('UPDATE intervals SET id = id + 100'))
+        conn.execute(text('UPDATE timetables SET interval_id = interval_id + 100'))
+    assert fetch_including('AAA', T0 + 600) == (T0, T0 + 1200)
+
+
+def test_rewritten_intervals_are_not_read_stale(db):
+    update_timetable('AAA', T0, timetable(0, 10, 20), db)
+    interval = IntervalRepo.fetch_including(db, 'AAA', T0)
+    stale_key = (interval.station_code, interval.id, interval.version)
+    stale = RouteFinder.fetch_saved_timetable(db, 'AAA', T0)
+    early = ColumnarTimetable.from_columns([T0 + 600], [T0 + 480], [1], ['T0010'])  # arrives a minute earlier
+    assert update_timetable('AAA', T0, early, db) == 1  # within the interval, rewritten in place
+    timetable_cache.put(stale_key, stale)  # put back by a reader that loaded the records before the change
+    with SessionLocal() as other:
+        assert IntervalRepo.fetch_including(other, 'AAA', T0).id == interval.id
+        assert T0 + 480 in RouteFinder.fetch_saved_timetable(other, 'AAA', T0).arrival.tolist()
+
+
+def test_intervals_are_extended_in_place(db, monkeypatch):
+    monkeypatch.setattr(settings, 'merge_gap', 0)
+    update_timetable('AAA', T0, timetable(0, 10, 20), db)
+    update_timetable('AAA', T0 + 2400, timetable(40, 50), db)
+    first = IntervalRepo.fetch_including(db, 'AAA', T0)
+    first_id, first_version = first.id, first.version
+    written = metrics.counters.get(('timetable_rows_written_total', ()), 0)
+    assert update_timetable('AAA', T0 + 1200, timetable(20, 30, 40), db) == 1  # fills the gap between the intervals
+    interval = IntervalRepo.fetch_including(db, 'AAA', T0 + 3000)
+    assert (interval.id, interval.start_timestamp, interval.stop_timestamp) == (first_id, T0, T0 + 3000)
+    assert interval.version > first_version and len(IntervalRepo.fetch_index(db, 'AAA').items) == 1
+    # the new record, and the records of the second interval re-pointed to the first one
+    assert metrics.counters[('timetable_rows_written_total', ())] - written == 1 + 2
@@ -0,0 +1,39 @@
+"""
+Upgrade of a database created by the first version
+"""
+import os
+import tempfile
+from sqlalchemy import create_engine, text
+import train_app.models as models
+
+# the tables of the first version
+FIRST_VERSION = [
+    'CREATE TABLE intervals (id INTEGER PRIMARY KEY, station_code VARCHAR(3) NOT NULL, start_timestamp INTEGER, '
+    'stop_timestamp INTEGER)',
+    'CREATE TABLE timetables (id INTEGER PRIMARY KEY, service INTEGER, train_uid VARCHAR(20) NOT NULL, '
+    'aimed_departure_timestamp INTEGER, aimed_arrival_timestamp INTEGER, '
+    'interval_id INTEGER NOT NULL REFERENCES intervals (id))',
+]
+
+
+def test_upgrade_first_version():
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'old.db')}")
+    with engine.begin() as conn:
+        for ddl in FIRST_VERSION:
+            conn.execute(text(ddl))
+        conn.execute(text("INSERT INTO intervals VALUES (1, 'AAA', 0, 100)"))
+        conn.execute(text("INSERT INTO timetables (service, train_uid, aimed_departure_timestamp, "
+                          "aimed_arrival_timestamp, interval_id) VALUES "
+                          "(1, 'T1', 10, 5, 1), (2, 'T1', 10, 5, 1), (1, 'T2', -1, 50, 1)"))
+
+    assert 'create uq_timetables_stop' in models.create_tables(engine)
+    with engine.begin() as conn:
+        rows = conn.execute(text('SELECT station_code, train_uid, event_timestamp, service FROM timetables '
+                                 'ORDER BY train_uid')).all()
+    assert rows == [('AAA', 'T1', 10, 2), ('AAA', 'T2', 50, 1)]  # the last record of a duplicated stop is kept
+    assert models.create_tables(engine) == []
+
+
+def test_create_new_database():
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'new.db')}")
+    assert models.create_tables(engine) == []
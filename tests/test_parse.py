@@ -0,0 +1,63 @@
+"""
+The vectorized parser against a row by row reference built on time_to_seconds
+"""
+import random
+import numpy as np
+from db import NAT
+from train_app.etl import parse_timetable
+from train_app.helpers import time_to_seconds, times_to_seconds, tptdt_2_timestamp
+
+
+def random_times(rnd: random.Random, n: int) -> list:
+    return [None if rnd.random() < 0.1 else f'{rnd.randrange(24):02d}:{rnd.randrange(60):02d}' for _ in range(n)]
+
+
+def reference_rows(json_obj: dict) -> list:
+    """
+    Parse a timetable one row at a time, like the parser did before it was vectorized
+    """
+    d_ref = tptdt_2_timestamp(f"{json_obj['date']} 00:00")
+    t_ref = time_to_seconds(json_obj['time_of_day'], 0)
+    rows = []
+    for d in json_obj['departures']['all']:
+        dept, arr = d['aimed_departure_time'], d['aimed_arrival_time']
+        rows.append((NAT if dept is None else d_ref + time_to_seconds(dept, t_ref),
+                     NAT if arr is None else d_ref + time_to_seconds(arr, t_ref),
+                     int(d['service']), d['train_uid']))
+    return sorted(rows)
+
+
+def test_times_to_seconds():
+    rnd = random.Random(0)
+    t_ref = time_to_seconds('14:17', 0)
+    # around the reference time, midnight and missing values
+    times = random_times(rnd, 500) + ['14:17', '14:16', '14:18', '00:00', '23:59', None]
+    seconds, valid = times_to_seconds(times, t_ref)
+    assert seconds.dtype == np.int64
+    assert valid.tolist() == [t is not None for t in times]
+    assert seconds.tolist() == [0 if t is None else time_to_seconds(t, t_ref) for t in times]
+
+
+def test_times_to_seconds_rollover():
+    seconds, valid = times_to_seconds(['22:00', '23:59', '00:00', '01:30'], time_to_seconds('22:00', 0))
+    assert seconds.tolist() == [79200, 86340, 86400, 91800]
+    assert valid.all()
+
+
+def test_parse_timetable():
+    rnd = random.Random(1)
+    for _ in range(50):
+        time_of_day = f'{rnd.randrange(24):02d}:{rnd.randrange(60):02d}'
+        json_obj = {'date': '2022-09-19', 'time_of_day': time_of_day, 'departures': {'all': [
+            {'aimed_departure_time': dept, 'aimed_arrival_time': arr, 'service': str(24000000 + rnd.randrange(10)),
+             'train_uid': f'C{rnd.randrange(10 ** 5):05d}'}
+            for dept, arr in zip(random_times(rnd, 40), random_times(rnd, 40))]}}
+        ttb = parse_timetable(json_obj)
+        for column in (ttb.departure, ttb.arrival, ttb.service):
+            assert column.dtype == np.int64
+        assert sorted(zip(ttb.departure.tolist(), ttb.arrival.tolist(), ttb.service.tolist(),
+                          ttb.train_uids())) == reference_rows(json_obj)
+
+
+def test_parse_empty_timetable():
+    assert parse_timetable({'date': '2022-09-19', 'time_of_day': '10:00', 'departures': {'all': []}}) is None
@@ -0,0 +1,33 @@
+"""
+Demand tracking and queuing of the background prefetch
+"""
+import asyncio
+from settings import settings
+from train_app.prefetch import DemandTracker, PrefetchScheduler
+
+T0 = 1663570800  # 2022-09-19 08:00
+
+
+def test_top_stations():
+    tracker = DemandTracker(half_life=1800)
+    tracker.record(['AAA', 'AAB'], now=T0)
+    tracker.record(['AAB'], now=T0 + 1800)
+    assert tracker.top(1, now=T0 + 1800) == ['AAB']
+    assert tracker.top(5, now=T0 + 1800) == ['AAB', 'AAA']
+    assert tracker.top(5, now=T0 + 86400) == []  # forgotten once cold
+
+
+def test_windows_of_a_station_are_queued_once_each(monkeypatch):
+    monkeypatch.setattr(settings, 'prefetch_queue_size', 3)
+    scheduler = PrefetchScheduler()
+    span = settings.download_concurrency * settings.t_window * 3600
+
+    async def run():
+        scheduler.queue = asyncio.Queue(maxsize=settings.prefetch_queue_size)
+        scheduler.enqueue([('AAA', T0), ('AAA', T0 + span), ('AAB', T0)])
+        scheduler.enqueue([('AAA', T0 + 60), ('AAA', T0 + span)])  # planned again a minute later
+        scheduler.enqueue([('AAA', T0 + 2 * span)])
+        return [scheduler.queue.get_nowait() for _ in range(scheduler.queue.qsize())]
+
+    assert asyncio.run(run()) == [('AAA', T0), ('AAA', T0 + span), ('AAB', T0)]
+    assert scheduler.dropped == 1
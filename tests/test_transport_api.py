@@ -0,0 +1,120 @@
+"""
+Retries, backoff and rate limiting of the Transport API client, against the local API stub
+"""
+import asyncio
+from time import monotonic
+import httpx
+import pytest
+from fastapi import FastAPI
+import train_app.transport_api as transport_api
+from bench.stub_server import make_stub_app
+from bench.synthetic import SyntheticNetwork
+from settings import settings
+from train_app.transport_api import TokenBucket, TransportApiClient
+
+NETWORK = SyntheticNetwork(n_stations=5, n_lines=1, stops_per_line=3)
+STATION = NETWORK.lines[0][0][0]
+URL = f'{settings.tpt_url}/{STATION}/timetable.json'
+PARAMS = {'date': '2022-09-19', 'time': '08:00'}
+
+
+@pytest.fixture
+def sleeps(monkeypatch) -> list:
+    """
+    The backoff delays requested by the client, which does not actually wait
+    """
+    delays = []
+
+    async def sleep(seconds):
+        delays.append(seconds)
+
+    monkeypatch.setattr(transport_api, 'sleep', sleep)
+    monkeypatch.setattr(settings, 'tpt_max_retries', 3)
+    monkeypatch.setattr(settings, 'tpt_retry_backoff', 0.5)
+    return delays
+
+
+def stub_client(*failures: tuple) -> (TransportApiClient, FastAPI):
+    """
+    A client of the API stub, which first answers the failures, given as (status code, headers)
+    :return: the client, and the stub app whose state.calls counts the calls
+    """
+    app = make_stub_app(NETWORK)
+    app.state.failures.extend(failures)
+    return TransportApiClient(httpx.ASGITransport(app=app)), app
+
+
+def test_retry_with_backoff(sleeps):
+    client, app = stub_client((429, {}), (503, {}))
+    assert asyncio.run(client.get_json(URL, PARAMS)) == NETWORK.timetable(STATION, **PARAMS)
+    assert app.state.calls == 3
+    assert len(sleeps) == 2
+    assert 0.5 <= sleeps[0] <= 0.75 and 1 <= sleeps[1] <= 1.5  # exponential backoff with jitter
+    assert client.stats.retries == 2 and client.stats.errors == 0
+
+
+def test_retry_after(sleeps):
+    client, _ = stub_client((429, {'Retry-After': '7'}), (429, {'Retry-After': '86400'}))
+    asyncio.run(client.get_json(URL, PARAMS))
+    assert sleeps == [7, settings.tpt_timeout]  # a bad header does not park the call
+
+
+def test_raise_after_max_retries(sleeps):
+    client, app = stub_client(*[(503, {})] * 10)
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(client.get_json(URL, PARAMS))
+    assert app.state.calls == settings.tpt_max_retries + 1
+    assert client.stats.errors == 1
+
+
+def test_transport_error(sleeps):
+    def handler(request: httpx.Request):
+        raise httpx.ConnectError('refused', request=request)
+
+    client = TransportApiClient(httpx.MockTransport(handler))
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(client.get_json(URL, PARAMS))
+    assert len(sleeps) == settings.tpt_max_retries
+
+
+def test_client_errors_are_not_retried(sleeps):
+    client, app = stub_client()
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(client.get_json(f'{settings.tpt_url}/XXX/timetable.json', PARAMS))  # unknown station
+    assert app.state.calls == 1 and not sleeps
+
+
+def test_client_of_previous_loop_is_closed():
+    client, _ = stub_client()
+    asyncio.run(client.get_json(URL, PARAMS))
+    first = client._client
+
+    async def run():
+        await client.get_json(URL, PARAMS)
+        await asyncio.gather(*client._closing)
+
+    asyncio.run(run())
+    assert first.is_closed and client._client is not first and not client._client.is_closed
+
+
+def test_token_bucket():
+    async def run() -> float:
+        bucket = TokenBucket(rate=20, capacity=2)
+        t = monotonic()
+        for _ in range(6):
+            await bucket.acquire()
+        return monotonic() - t
+
+    elapsed = asyncio.run(run())
+    assert 0.19 <= elapsed < 0.5  # a burst of 2 calls, then 4 calls at 20 per second
+
+
+def test_token_bucket_unlimited():
+    async def run():
+        bucket = TokenBucket(rate=0, capacity=1)
+        for _ in range(100):
+            await bucket.acquire()
+
+    t = monotonic()
+    asyncio.run(run())
+    assert monotonic() - t < 0.1
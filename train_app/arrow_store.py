@@ -0,0 +1,192 @@
+"""
+Timetables stored as memory-mapped Arrow files, one per station and (UTC) day
+"""
+import os
+from time import gmtime, strftime
+from typing import Dict, List
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from settings import settings
+from train_app.columnar import ColumnarTimetable, uid_interner
+from train_app.metrics import metrics
+from train_app.models import Interval
+
+try:
+    import pyarrow as pa
+except ImportError:  # optional dependency, only needed by the arrow backend
+    pa = None
+
+DAY = 86400
+
+
+class ArrowTimetableRepo:
+    """
+    Drop-in replacement of TimetableRepo keeping the records of a station and day in an Arrow IPC file, rows sorted by
+    departure. Files are memory-mapped, so reading a station-day is zero-copy apart from the few distinct train uids.
+    Records are not tied to an interval: the records of an interval are the ones of its station with an event
+    timestamp within it, so merging intervals needs no rewrite, and a day file is compacted whenever it is written.
+    """
+    @staticmethod
+    def day_path(station: str, day: int) -> str:
+        return os.path.join(settings.arrow_dir, station, strftime('%Y-%m-%d.arrow', gmtime(day * DAY)))
+
+    @classmethod
+    def read_day(cls, station: str, day: int) -> ColumnarTimetable:
+        """
+        Read the records of a station and day
+        :param station: station code
+        :param day: days since the epoch
+        :return: the columnar timetable, empty if there is no record
+        """
+        path = cls.day_path(station, day)
+        if not os.path.exists(path):
+            return ColumnarTimetable.empty()
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all().combine_chunks()
+        uid = table.column('train_uid').chunk(0)
+        # only the dictionary of distinct uids is converted to python strings
+        codes = uid_interner.intern(uid.dictionary.to_pylist())[uid.indices.to_numpy()]
+        return ColumnarTimetable(table.column('departure').to_numpy(), table.column('arrival').to_numpy(),
+                                 table.column('service').to_numpy(), codes, is_sorted=True)
+
+    @classmethod
+    def write_day(cls, station: str, day: int, ttb: ColumnarTimetable):
+        """
+        Replace the file of a station and day, atomically so that readers see either the old or the new file
+        """
+        path = cls.day_path(station, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        dictionary, indices = np.unique(ttb.uid, return_inverse=True)
+        uid = pa.DictionaryArray.from_arrays(pa.array(indices.astype(np.int32)),
+                                             pa.array(uid_interner.lookup(dictionary.tolist()), pa.string()))
+        table = pa.table({'departure': ttb.departure, 'arrival': ttb.arrival, 'service': ttb.service,
+                          'train_uid': uid})
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    @metrics.timed('timetable_write')
+    def bulk_upsert(cls, db: Session, station: str, interval_id: int, ttb: ColumnarTimetable) -> int:
+        """
+        Insert the records of a timetable, or replace the existing records of the same train stops that differ. The
+        day files with changes are rewritten immediately, they do not take part in the db transaction.
+        :param db: database session, unused
+        :param station: station code
+        :param interval_id: id of the interval the records belong to, unused
+        :param ttb: the timetable
+        :return: number of records written
+        """
+        if not len(ttb):
+            return 0
+        days = ttb.event_timestamps() // DAY
+        rows = 0
+        for day in np.unique(days).tolist():
+            new = ttb.take(days == day)
+            old = cls.read_day(station, day)
+            # (train code, event timestamp) identifies a record, see uq_timetables_stop
+            new_keys = (new.uid.astype(np.int64) << 32) | new.event_timestamps()
+            old_keys = (old.uid.astype(np.int64) << 32) | old.event_timestamps()
+            same = np.zeros(len(new), dtype=bool)  # whether each new record is already saved as is
+            if len(old):
+                order = np.argsort(old_keys)
+                idx = order[np.searchsorted(old_keys, new_keys, sorter=order).clip(max=len(old) - 1)]
+                same = (old_keys[idx] == new_keys) & (old.departure[idx] == new.departure) & \
+                    (old.arrival[idx] == new.arrival) & (old.service[idx] == new.service)
+            if same.all():  # nothing new in the day
+                continue
+            rows += int((~same).sum())
+            cls.write_day(station, day, ColumnarTimetable.concat([old.take(~np.isin(old_keys, new_keys)), new]))
+        return rows
+
+    @staticmethod
+    def bulk_move_to_interval(db: Session, ids: List[int], interval_id: int) -> int:
+        """
+        Nothing to do, as records are found by time rather than by interval
+        """
+        return 0
+
+    @classmethod
+    def fetch_columnar_by_train_uids(cls, db: Session, uids: List[str], t0: int, t1: int,
+                                     exclude_station: str = None) -> Dict[str, ColumnarTimetable]:
+        """
+        Load the records of some trains at all stations, within a time range, scanning the day files of the stations
+        with an interval overlapping the range
+        :param db: database session
+        :param uids: train uids
+        :param t0: min event timestamp
+        :param t1: max event timestamp
+        :param exclude_station: station whose records are not loaded
+        :return: the timetable of each station the trains stop at
+        """
+        codes = uid_interner.intern(uids)
+        res = {}
+        stations = db.scalars(select(Interval.station_code).distinct()
+                              .where(Interval.start_timestamp <= t1, Interval.stop_timestamp >= t0)).all()
+        for station in stations:
+            if station == exclude_station:
+                continue
+            timetables = []
+            for day in range(t0 // DAY, t1 // DAY + 1):
+                ttb = cls.read_day(station, day)
+                event = ttb.event_timestamps()
+                timetables.append(ttb.take(np.isin(ttb.uid, codes) & (event >= t0) & (event <= t1)))
+            ttb = ColumnarTimetable.concat(timetables)
+            if len(ttb):
+                res[station] = ttb
+        return res
+
+    @classmethod
+    def bulk_delete_by_intervals(cls, db: Session, intervals: List[Interval]) -> int:
+        """
+        Delete all records of the intervals, removing the day files left empty
+        :param db: database session, unused
+        :param intervals: the intervals
+        :return: number of records deleted
+        """
+        rows = 0
+        for interval in intervals:
+            start, stop = interval.start_timestamp, interval.stop_timestamp
+            for day in range(start // DAY, stop // DAY + 1):
+                ttb = cls.read_day(interval.station_code, day)
+                event = ttb.event_timestamps()
+                inside = (event >= start) & (event <= stop)
+                n = int(inside.sum())
+                if not n:
+                    continue
+                if n == len(ttb):
+                    os.remove(cls.day_path(interval.station_code, day))
+                else:
+                    cls.write_day(interval.station_code, day, ttb.take(~inside))
+                rows += n
+        return rows
+
+    @staticmethod
+    def delete_orphans(db: Session) -> int:
+        """
+        Nothing to do, as records are found by time: records outside of any interval are never read, and are
+        deleted along with the interval that covers them later
+        """
+        return 0
+
+    @classmethod
+    @metrics.timed('timetable_read')
+    def fetch_columnar_by_interval_id(cls, db: Session, interval_id: int) -> ColumnarTimetable:
+        """
+        Load the timetable of an interval from the files of the days it spans
+        :param db: database session
+        :param interval_id: interval id
+        :return: the columnar timetable
+        """
+        interval = db.get(Interval, interval_id)
+        if interval is None:
+            return ColumnarTimetable.empty()
+        start, stop = interval.start_timestamp, interval.stop_timestamp
+        res = []
+        for day in range(start // DAY, stop // DAY + 1):
+            ttb = cls.read_day(interval.station_code, day)
+            event = ttb.event_timestamps()
+            inside = (event >= start) & (event <= stop)
+            res.append(ttb if inside.all() else ttb.take(inside))
+        return res[0] if len(res) == 1 else ColumnarTimetable.concat(res)
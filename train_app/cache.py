@@ -0,0 +1,164 @@
+"""
+In-process LRU caches of the saved timetables and of the journeys found
+"""
+from collections import OrderedDict
+from threading import RLock
+from time import monotonic
+from typing import Any, Hashable, Iterable, List
+from settings import settings
+from train_app.schemas import Journey
+
+
+class LRUCache:
+    """
+    A thread-safe LRU cache whose entries also expire after a fixed time-to-live
+    """
+    def __init__(self, max_size: int, ttl: float):
+        """
+        :param max_size: maximum number of entries kept in memory
+        :param ttl: time to live of an entry, in seconds. 0 means entries never expire
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expiry, value)
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key: Hashable):
+        return self.get(key, count=False) is not None
+
+    def get(self, key: Hashable, count: bool = True) -> Any or None:
+        """
+        Return the value cached under the key, or None if it is missing or expired
+        :param key: cache key
+        :param count: whether the lookup is counted in the hit/miss statistics
+        :return: the cached value, or None
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] and item[0] < monotonic():  # expired
+                del self._data[key]
+                item = None
+            if count:
+                if item is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            if item is None:
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def put(self, key: Hashable, value: Any):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (monotonic() + self.ttl if self.ttl else 0, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)  # evict the least recently used entry
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def pop_where(self, predicate) -> int:
+        """
+        Remove all entries whose key satisfies the predicate
+        :param predicate: a function that takes a key and returns a bool
+        :return: number of entries removed
+        """
+        with self._lock:
+            keys = [k for k in self._data if predicate(k)]
+            for k in keys:
+                del self._data[k]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'max_size': self.max_size, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses}
+
+
+class TimetableCache(LRUCache):
+    """
+    Timetables of stations keyed by (station code, interval id, interval version). The version of an interval is bumped
+    whenever its records change, so an entry is never read once stale, even if put by a reader racing the change. Stale
+    entries are dropped to free memory, or left to expire.
+    """
+    def invalidate(self, station: str, interval_ids: Iterable[int] = None) -> int:
+        """
+        Drop cached timetables of a station
+        :param station: station code
+        :param interval_ids: ids of the intervals to drop. All intervals of the station are dropped if not given
+        :return: number of entries removed
+        """
+        if interval_ids is None:
+            return self.pop_where(lambda k: k[0] == station)
+        ids = set(interval_ids)
+        return self.pop_where(lambda k: k[0] == station and k[1] in ids)
+
+
+class JourneyCache(LRUCache):
+    """
+    Journeys keyed by (stations, start time bucket, max waiting). The journey found for a start time t0 is also the
+    journey of any later start time of the bucket, as long as its first train has not left yet: every train that can be
+    taken from the later start time could be taken from t0, so no better journey exists.
+    """
+    def __init__(self, max_size: int, ttl: float, bucket: int):
+        """
+        :param max_size: maximum number of journeys kept in memory
+        :param ttl: time to live of a journey, in seconds
+        :param bucket: width of the start time buckets, in seconds
+        """
+        super().__init__(max_size, ttl)
+        self.bucket = bucket
+
+    def make_key(self, stations: List[str], start_time: int, max_waiting: int) -> tuple:
+        return tuple(stations), start_time // self.bucket, max_waiting
+
+    def get_journey(self, stations: List[str], start_time: int, max_waiting: int) -> Journey or None:
+        """
+        Return the cached journey of a query, or None
+        :param stations: normalized station codes
+        :param start_time: timestamp of the start time
+        :param max_waiting: the maximum time the passenger is willing to wait (in minutes)
+        :return: the journey, or None if not cached or not valid for the start time
+        """
+        item = self.get(self.make_key(stations, start_time, max_waiting), count=False)
+        if item is not None and item[0] <= start_time <= item[1]:
+            self.hits += 1
+            return item[2]
+        self.misses += 1
+        return None
+
+    def put_journey(self, stations: List[str], start_time: int, max_waiting: int, first_departure: int,
+                    journey: Journey):
+        """
+        :param stations: normalized station codes
+        :param start_time: timestamp of the start time the journey was searched from
+        :param max_waiting: the maximum time the passenger is willing to wait (in minutes)
+        :param first_departure: departure timestamp of the first train of the journey
+        :param journey: the journey
+        """
+        self.put(self.make_key(stations, start_time, max_waiting), (start_time, first_departure, journey))
+
+    def invalidate(self, station: str) -> int:
+        """
+        Drop the cached journeys through a station
+        :param station: station code
+        :return: number of entries removed
+        """
+        return self.pop_where(lambda k: station in k[0])
+
+
+timetable_cache = TimetableCache(settings.ttb_cache_size, settings.ttb_cache_ttl)
+journey_cache = JourneyCache(settings.journey_cache_size, settings.journey_cache_ttl, settings.journey_cache_bucket)
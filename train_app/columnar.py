@@ -0,0 +1,154 @@
+"""
+Compact columnar timetables
+"""
+import hashlib
+from threading import Lock
+from typing import Iterable, List, Sequence
+import numpy as np
+from db import NAT
+
+
+class UidInterner:
+    """
+    Map train uids to small integer codes, so that timetables hold int32 arrays instead of python strings
+    """
+    def __init__(self):
+        self.codes = {}
+        self.uids = []
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.uids)
+
+    def intern(self, uids: Iterable[str]) -> np.ndarray:
+        """
+        Return the codes of the uids, assigning new codes to the uids never seen before
+        """
+        codes = self.codes
+        res = []
+        with self._lock:
+            for uid in uids:
+                code = codes.get(uid)
+                if code is None:
+                    code = codes[uid] = len(self.uids)
+                    self.uids.append(uid)
+                res.append(code)
+        return np.array(res, dtype=np.int32)
+
+    def lookup(self, codes: Iterable[int]) -> List[str]:
+        uids = self.uids
+        return [uids[c] for c in codes]
+
+
+uid_interner = UidInterner()
+
+
+class ColumnarTimetable:
+    """
+    Timetable of a station held as one numpy array per field, rows sorted by departure timestamp.
+    Records without a departure (NAT) come first.
+    """
+    __slots__ = ('departure', 'arrival', 'service', 'uid')
+
+    def __init__(self, departure: np.ndarray, arrival: np.ndarray, service: np.ndarray, uid: np.ndarray,
+                 is_sorted: bool = False):
+        """
+        :param departure: int64 aimed departure timestamps
+        :param arrival: int64 aimed arrival timestamps
+        :param service: int64 service ids
+        :param uid: int32 train uid codes, see uid_interner
+        :param is_sorted: whether the rows are already sorted by departure
+        """
+        if not is_sorted:
+            order = np.argsort(departure, kind='stable')
+            departure, arrival, service, uid = departure[order], arrival[order], service[order], uid[order]
+        self.departure = departure
+        self.arrival = arrival
+        self.service = service
+        self.uid = uid
+
+    def __len__(self):
+        return len(self.departure)
+
+    @property
+    def nbytes(self) -> int:
+        return self.departure.nbytes + self.arrival.nbytes + self.service.nbytes + self.uid.nbytes
+
+    @classmethod
+    def empty(cls) -> 'ColumnarTimetable':
+        return cls(np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int32), True)
+
+    @classmethod
+    def from_columns(cls, departure: Sequence[int], arrival: Sequence[int], service: Sequence[int],
+                     train_uid: Sequence[str]) -> 'ColumnarTimetable':
+        return cls(np.asarray(departure, dtype=np.int64), np.asarray(arrival, dtype=np.int64),
+                   np.asarray(service, dtype=np.int64), uid_interner.intern(train_uid))
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[tuple]) -> 'ColumnarTimetable':
+        """
+        Make a timetable from (aimed_departure_timestamp, aimed_arrival_timestamp, service, train_uid) rows
+        """
+        if not len(rows):
+            return cls.empty()
+        return cls.from_columns(*zip(*rows))
+
+    @classmethod
+    def concat(cls, timetables: List['ColumnarTimetable']) -> 'ColumnarTimetable':
+        return cls(np.concatenate([t.departure for t in timetables]), np.concatenate([t.arrival for t in timetables]),
+                   np.concatenate([t.service for t in timetables]), np.concatenate([t.uid for t in timetables]))
+
+    def take(self, idx) -> 'ColumnarTimetable':
+        """
+        Select rows by a boolean mask, a slice or (sorted) indices
+        """
+        return ColumnarTimetable(self.departure[idx], self.arrival[idx], self.service[idx], self.uid[idx], True)
+
+    def unique(self) -> 'ColumnarTimetable':
+        """
+        Remove duplicated rows
+        """
+        if not len(self):
+            return self
+        order = np.lexsort((self.service, self.uid, self.arrival, self.departure))
+        rows = np.stack([self.departure, self.arrival, self.service, self.uid.astype(np.int64)])[:, order]
+        keep = np.ones(len(order), dtype=bool)
+        keep[1:] = (rows[:, 1:] != rows[:, :-1]).any(axis=0)
+        return self.take(order[keep])
+
+    def valid(self) -> 'ColumnarTimetable':
+        """
+        Remove records that have neither departure nor arrival time
+        """
+        return self.take((self.departure != NAT) | (self.arrival != NAT))
+
+    def event_timestamps(self) -> np.ndarray:
+        """
+        Return the timestamp identifying each record: the departure, or the arrival of a terminating train
+        """
+        return np.where(self.departure != NAT, self.departure, self.arrival)
+
+    def departures_from(self, t: int) -> 'ColumnarTimetable':
+        """
+        Return the records departing at or after t, found by bisection
+        """
+        return self.take(slice(np.searchsorted(self.departure, t), None))
+
+    def fingerprint(self) -> str:
+        """
+        Return a digest of the records, independent of their order and of the codes the train uids are interned as
+        """
+        codes, inverse = np.unique(self.uid, return_inverse=True)
+        uids = uid_interner.lookup(codes.tolist())
+        rank = np.empty(len(uids), dtype=np.int64)
+        rank[sorted(range(len(uids)), key=uids.__getitem__)] = np.arange(len(uids))
+        uid_rank = rank[inverse.reshape(-1)]
+        order = np.lexsort((self.service, uid_rank, self.arrival, self.departure))
+        digest = hashlib.blake2b(digest_size=16)
+        for column in (self.departure, self.arrival, self.service, uid_rank):
+            digest.update(np.ascontiguousarray(column[order], dtype=np.int64).tobytes())
+        digest.update('\n'.join(sorted(uids)).encode())
+        return digest.hexdigest()
+
+    def train_uids(self) -> List[str]:
+        return uid_interner.lookup(self.uid.tolist())
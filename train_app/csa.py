@@ -0,0 +1,141 @@
+"""
+Connection Scan Algorithm (CSA) for the earliest arrival along a route
+"""
+from typing import List
+import numpy as np
+from db import NAT
+from train_app.columnar import ColumnarTimetable
+from settings import settings
+
+INF = np.iinfo(np.int64).max
+
+
+class Connections:
+    """
+    Elementary train connections between consecutive stations of a route, sorted by departure timestamp
+    """
+    def __init__(self, leg: np.ndarray, departure: np.ndarray, arrival: np.ndarray, uid: np.ndarray):
+        """
+        :param leg: index of the leg, i.e. the connection runs from stations[leg] to stations[leg + 1]
+        :param departure: departure timestamp of the connection
+        :param arrival: arrival timestamp of the connection
+        :param uid: code of the train of the connection, see uid_interner
+        """
+        self.leg = leg
+        self.departure = departure
+        self.arrival = arrival
+        self.uid = uid
+
+    def __len__(self):
+        return len(self.departure)
+
+
+def join_first_arrival(dept_uid: np.ndarray, dept_ts: np.ndarray, arr_uid: np.ndarray, arr_ts: np.ndarray,
+                       max_journey: int) -> (np.ndarray, np.ndarray):
+    """
+    Sort-merge join of departures and arrivals on the train, matching each departure with the first arrival of the
+    same train after it, within max_journey seconds
+    :param dept_uid: train codes of the departures
+    :param dept_ts: departure timestamps
+    :param arr_uid: train codes of the arrivals
+    :param arr_ts: arrival timestamps
+    :param max_journey: longest journey to consider, in seconds
+    :return: indices of the matched departures, and the matched arrival timestamps
+    """
+    # (train code, timestamp) packed in a single sortable int64 key
+    arr_keys = np.sort((arr_uid.astype(np.int64) << 32) | arr_ts)
+    idx = np.searchsorted(arr_keys, (dept_uid.astype(np.int64) << 32) | (dept_ts + 1))
+    found = idx < len(arr_keys)
+    idx[~found] = 0
+    matched = arr_keys[idx] if len(arr_keys) else np.zeros(len(idx), dtype=np.int64)
+    arrival = matched & 0xFFFFFFFF
+    found &= ((matched >> 32) == dept_uid) & (arrival - dept_ts <= max_journey)
+    return np.flatnonzero(found), arrival[found]
+
+
+def pair_connections(from_ttb: ColumnarTimetable, to_ttb: ColumnarTimetable) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Connections from a station to another one: every departure matched with the first arrival of the same train
+    :param from_ttb: the timetable of the departure station
+    :param to_ttb: the timetable of the arrival station
+    :return: the train codes, departure and arrival timestamps of the connections
+    """
+    dept_ttb = from_ttb.take(from_ttb.departure != NAT)
+    arr_valid = to_ttb.arrival != NAT
+    idx, arrival = join_first_arrival(dept_ttb.uid, dept_ttb.departure, to_ttb.uid[arr_valid], to_ttb.arrival[arr_valid],
+                                      settings.max_single_journey)
+    return dept_ttb.uid[idx], dept_ttb.departure[idx], arrival
+
+
+def build_connections(timetables: List[ColumnarTimetable], t_start: int) -> Connections:
+    """
+    Build the connections of a route from the timetables of its stations
+    :param timetables: the timetable of each station of the route, in order
+    :param t_start: departures before this timestamp are ignored
+    :return: the connections sorted by departure
+    """
+    legs, departures, arrivals, codes = [], [], [], []
+    for i in range(len(timetables) - 1):
+        dept_ttb, target_ttb = timetables[i].departures_from(t_start), timetables[i + 1]
+        arr_valid = target_ttb.arrival != NAT
+        idx, arrival = join_first_arrival(dept_ttb.uid, dept_ttb.departure, target_ttb.uid[arr_valid],
+                                          target_ttb.arrival[arr_valid], settings.max_single_journey)
+        legs.append(np.full(len(idx), i))
+        departures.append(dept_ttb.departure[idx])
+        arrivals.append(arrival)
+        codes.append(dept_ttb.uid[idx])
+    departure = np.concatenate(departures)
+    order = np.argsort(departure, kind='stable')
+    return Connections(np.concatenate(legs)[order], departure[order], np.concatenate(arrivals)[order],
+                       np.concatenate(codes)[order])
+
+
+def scan_earliest_arrival(conns: Connections, n_stations: int, t_start: int) -> (List[int], List[int]):
+    """
+    Compute the earliest arrival at every station of the route in one scan of the connections
+    :param conns: the connections sorted by departure
+    :param n_stations: number of stations of the route
+    :param t_start: timestamp the passenger is ready at the first station
+    :return: the earliest arrival at each station (INF if unreachable), and the index of the connection taken to reach
+    each station (-1 if none)
+    """
+    earliest = [INF] * n_stations
+    earliest[0] = t_start
+    taken = [-1] * n_stations
+    for c, (leg, dept, arr) in enumerate(zip(conns.leg.tolist(), conns.departure.tolist(), conns.arrival.tolist())):
+        if dept >= earliest[-1]:  # no later connection can improve the arrival at the destination
+            break
+        if earliest[leg] <= dept and arr < earliest[leg + 1]:
+            earliest[leg + 1] = arr
+            taken[leg + 1] = c
+    return earliest, taken
+
+
+def suffix_best(arrival: np.ndarray) -> np.ndarray:
+    """
+    Arrival profile of a leg, in one backward sweep of its connections sorted by departure: for each connection, the
+    index of the connection arriving first among it and the ones departing after it, the earliest departing one on
+    ties, i.e. the connection taken by a passenger ready at its departure time
+    :param arrival: arrival timestamps of the connections, sorted by departure
+    :return: the index of the connection taken from each connection on
+    """
+    # (arrival, index) packed in a single int64 key, so that the running minimum also breaks the ties. Arrivals are
+    # offset by the earliest one, as timestamps from 2038 on would overflow the upper 31 bits
+    base = arrival.min() if len(arrival) else 0
+    keys = ((arrival.astype(np.int64) - base) << 32) | np.arange(len(arrival))
+    return np.minimum.accumulate(keys[::-1])[::-1] & 0xFFFFFFFF
+
+
+def earliest_connections(departure: np.ndarray, best: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """
+    Look up the connection taken by passengers ready at many times
+    :param departure: departure timestamps of the connections, sorted
+    :param best: the arrival profile of the connections, see suffix_best
+    :param times: the times the passengers are ready at the departure station
+    :return: the index of the connection taken at each time, -1 if there is none
+    """
+    idx = np.searchsorted(departure, times)
+    found = idx < len(departure)
+    res = np.full(len(times), -1, dtype=np.int64)
+    res[found] = best[idx[found]]
+    return res
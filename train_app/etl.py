@@ -3,84 +3,161 @@
 # @Time    : 2022/7/31 11:50
 # @Author  : liyun
 # @desc    :
-from datetime import datetime
-from db import NAT
-import pytz
+from db import NAT, run_in_session
 from sqlalchemy.orm import Session
 from settings import settings
-from asyncio import gather
-import pandas as pd
-import httpx
-from helpers import time_to_seconds, tptdt_2_timestamp
-from models import Interval
-from transport_api import download_multiple_timetables
-import tempfile
+from operator import itemgetter
+import numpy as np
+from train_app.helpers import time_to_seconds, times_to_seconds, tptdt_2_timestamp
+from train_app.transport_api import has_touching_ranges, plan_windows, stream_timetables
 import json
-from repositories import IntervalRepo, TimetableRepo
-from schemas import IntervalCreate
+from train_app.repositories import ConnectionRepo, FingerprintRepo, IntervalRepo, timetable_repo
+from train_app.schemas import IntervalCreate
+from train_app.cache import journey_cache, timetable_cache
+from train_app.columnar import ColumnarTimetable, uid_interner
+from train_app.maintenance import compact_station
+from train_app.metrics import metrics
+from train_app.shared import shared_state, shared_ttb_cache
+from train_app.singleflight import SingleFlight
 
+downloads = SingleFlight()  # downloads in flight, keyed by (station, start of the window)
 
-def parse_timetable(json_obj: dict) -> pd.DataFrame or None:
+
+@metrics.timed('parse')
+def parse_timetable(json_obj: dict) -> ColumnarTimetable or None:
     """
     Parse the json format timetable received from the Transport API
     :param json_obj: a json dictionary object
-    :return: the timetable dataframe, or None if the station of interest has no departure information
+    :return: the columnar timetable, or None if the station of interest has no departure information
     """
     date_str, time_str, dept_list = json_obj['date'], json_obj['time_of_day'], json_obj['departures']['all']
     if not len(dept_list):
         return None
     d_ref, t_ref = tptdt_2_timestamp(f'{date_str} 00:00'), time_to_seconds(time_str, 0)
-    adt = [d_ref + time_to_seconds(t['aimed_departure_time'], t_ref) if t['aimed_departure_time'] is not None else NAT
-           for t in dept_list]
-    aat = [d_ref + time_to_seconds(t['aimed_arrival_time'], t_ref) if t['aimed_arrival_time'] is not None else NAT
-           for t in dept_list]
-    df = pd.DataFrame({'aimed_departure_timestamp': adt, 'aimed_arrival_timestamp': aat})
-    df[['service', 'train_uid']] = [int(s['service']) for s in dept_list], [t['train_uid'] for t in dept_list]
-    return df
+    # a single pass over the departures, the columns are then converted as a whole
+    dept_times, arr_times, services, train_uids = zip(*map(
+        itemgetter('aimed_departure_time', 'aimed_arrival_time', 'service', 'train_uid'), dept_list))
+    adt, adt_valid = times_to_seconds(dept_times, t_ref)
+    aat, aat_valid = times_to_seconds(arr_times, t_ref)
+    return ColumnarTimetable(np.where(adt_valid, d_ref + adt, NAT), np.where(aat_valid, d_ref + aat, NAT),
+                             np.array(services).astype(np.int64), uid_interner.intern(train_uids))
 
 
-def update_timetable(station: str, t0: int, df_ttb: pd.DataFrame, db: Session):
+@metrics.timed('merge')
+def update_timetable(station: str, t0: int, ttb: ColumnarTimetable, db: Session, commit: bool = True) -> int:
     """
-    Update interval and timetable records
+    Update interval and timetable records in a single transaction. The earliest existing interval the timetable
+    overlaps with or touches (at most settings.merge_gap apart) is extended in place to absorb the others, whose
+    records are re-pointed to it, then the new records are upserted. Every interval whose records change gets a new
+    version (see IntervalRepo.revise). Nothing is written if the timetable is the same as the last one merged for the
+    station and t0 (see FingerprintRepo) and is still saved, and only the records that differ are written if it falls
+    within an existing interval.
     :param station: station code
     :param t0: start timestamp of the timetable
-    :param df_ttb: a contiguous timetable dataframe
+    :param ttb: a contiguous timetable
     :param db: db session
-    :return:
+    :param commit: whether to commit the transaction. If not, the changes are only flushed, so that the caller can
+    batch many updates in a single transaction
+    :return: number of records of the timetable written
     """
-    df_adt_valid = df_ttb[df_ttb['aimed_departure_timestamp'] != NAT]
-    if not len(df_adt_valid):  # do nothing if no valid departure timestamp
-        return
-    # remove all records that have neither departure nor arrival time
-    df_ttb = df_ttb[(df_ttb['aimed_departure_timestamp'] != NAT) | (df_ttb['aimed_arrival_timestamp'] != NAT)]
+    ttb = ttb.valid()  # remove all records that have neither departure nor arrival time
+    if not len(ttb):  # do nothing if no valid timestamp
+        return 0
+    # the last departure, or the last arrival of a train terminating at the station if later
+    t_max = int(ttb.event_timestamps().max())
 
-    t_max = df_adt_valid['aimed_departure_timestamp'].max()
     interval_left = IntervalRepo.fetch_including(db, station, t0)
-    interval_right = IntervalRepo.fetch_including(db, station, t_max)
-    intervals_to_merge = list(IntervalRepo.fetch_included(db, station, t0, t_max))
-    interval_new = IntervalCreate(**{'station_code': station, 'start_timestamp': t0, 'stop_timestamp': t_max})
-    if interval_left is not None:
-        interval_new.start_timestamp = interval_left.start_timestamp
-        intervals_to_merge.append(interval_left)
-    if interval_right is not None:
-        interval_new.stop_timestamp = interval_right.stop_timestamp
-        intervals_to_merge.append(interval_right)
-
-    # todo: use transactions
-    interval = IntervalRepo.create(db, interval_new)
-    if not len(intervals_to_merge):  # for a completely new interval
-        df_ttb['interval_id'] = interval.id
-        TimetableRepo.bulk_insert_by_df(db, df_ttb)
-        return
-
-    # The new interval overlaps with some existing intervals
-    id_all = [intl.id for intl in intervals_to_merge]
-    df_timetable = pd.DataFrame(TimetableRepo.fetch_by_multiple_interval_ids(db, id_all))
-    df_merged = df_timetable.merge(df_ttb, how='outer', on=df_ttb.columns)  # perform outer join
-    df_merged['interval_id'] = interval.id
-    TimetableRepo.bulk_update_by_df(db, df_merged[df_merged['id'].notna()])  # update new interval id
-    TimetableRepo.bulk_insert_by_df(db, df_merged[df_merged['id'].isna()])   # insert new records
-    IntervalRepo.bulk_delete_by_id(db, id_all)  # finally remove all intervals that has been merged
+    covered = interval_left is not None and interval_left.stop_timestamp >= t_max
+    digest = ttb.fingerprint()
+    unchanged = FingerprintRepo.fetch(db, station, t0) == digest
+    metrics.inc('timetable_fingerprints_total', result='hit' if unchanged else 'miss')
+    if unchanged and covered:  # the same timetable is already saved
+        metrics.inc('timetable_updates_skipped_total')
+        return 0
+    if covered:  # the records that differ are upserted into the interval, no interval to merge
+        try:
+            rows = timetable_repo.bulk_upsert(db, station, interval_left.id, ttb)
+            if rows:
+                IntervalRepo.revise(db, interval_left)
+                if settings.connection_index:
+                    ConnectionRepo.bulk_upsert(db, station, ttb)
+            FingerprintRepo.upsert(db, station, t0, digest)
+            if commit:
+                db.commit()
+            else:
+                db.flush()
+        except Exception:
+            db.rollback()
+            raise
+        metrics.inc('timetable_rows_written_total', rows)
+        if rows:
+            timetable_cache.invalidate(station, [interval_left.id])
+            shared_ttb_cache.invalidate(station, interval_left.id)
+            journey_cache.invalidate(station)
+            shared_state.bump([station])
+        return rows
+
+    gap = settings.merge_gap  # e.g. consecutive windows, the last event of a window being before the next one starts
+    if interval_left is None:
+        interval_left = IntervalRepo.fetch_including(db, station, t0 - gap)
+    interval_right = IntervalRepo.fetch_including(db, station, t_max + gap)
+    intervals_to_merge = {intl.id: intl for intl in IntervalRepo.fetch_included(db, station, t0 - gap, t_max + gap)}
+    for intl in (interval_left, interval_right):
+        if intl is not None:
+            intervals_to_merge[intl.id] = intl
+    merged = sorted(intervals_to_merge.values(), key=lambda intl: intl.start_timestamp)
+    start = min([t0] + [intl.start_timestamp for intl in merged])
+    stop = max([t_max] + [intl.stop_timestamp for intl in merged])
+
+    id_all = list(intervals_to_merge)
+    moved = 0
+    try:
+        if merged:  # the earliest interval absorbs the others, its records stay in place
+            interval, id_absorbed = merged[0], [intl.id for intl in merged[1:]]
+            if id_absorbed:
+                moved = timetable_repo.bulk_move_to_interval(db, id_absorbed, interval.id)
+                IntervalRepo.bulk_delete_by_id(db, id_absorbed)  # remove all intervals that have been absorbed
+            IntervalRepo.revise(db, interval, start, stop)
+        else:
+            interval = IntervalRepo.create(db, IntervalCreate(
+                station_code=station, start_timestamp=start, stop_timestamp=stop), commit=False)
+        rows = timetable_repo.bulk_upsert(db, station, interval.id, ttb)
+        if settings.connection_index:
+            ConnectionRepo.bulk_upsert(db, station, ttb)
+        FingerprintRepo.upsert(db, station, t0, digest)
+        if commit:
+            db.commit()
+        else:
+            db.flush()
+    except Exception:
+        db.rollback()
+        raise
+    metrics.inc('timetable_rows_written_total', rows + moved)
+    timetable_cache.invalidate(station, id_all)
+    for interval_id in id_all:
+        shared_ttb_cache.invalidate(station, interval_id)
+    journey_cache.invalidate(station)
+    shared_state.bump([station])
+    return rows
+
+
+def merge_touching_intervals(station: str, db: Session) -> int:
+    """
+    Merge the intervals of a station that touch each other in a single transaction, see maintenance.compact_station
+    :param station: station code
+    :param db: db session
+    :return: number of intervals removed
+    """
+    try:
+        removed = compact_station(db, station, settings.merge_gap)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    if removed:
+        journey_cache.invalidate(station)
+        shared_state.bump([station])
+    return removed
 
 
 def read_json_file(file: str) -> dict:
@@ -93,16 +170,47 @@ def read_json_file(file: str) -> dict:
         return json.load(f)
 
 
-async def load_timetable(station: str, t0: int, db: Session):
+async def load_timetable(station: str, t0: int):
     """
-    Download timetables and store them into database
+    Download timetables and store them into database. Concurrent calls for the same station and time window are
+    coalesced into a single download, starting at the beginning of the window.
+    :param station: station code
+    :param t0: start timestamp of the timetable
+    :return:
+    """
+    t_start = t0 - t0 % settings.single_flight_window
+    if (station, t_start) in downloads:
+        metrics.inc('timetable_loads_coalesced_total')
+    await downloads.do((station, t_start), download_and_update_timetable, station, t_start)
+
+
+async def download_and_update_timetable(station: str, t0: int):
+    """
+    Download timetables and store them into database. Each timetable is parsed as soon as it arrives, while the
+    remaining ones are still being downloaded. The update runs in the db writer thread. Workers sharing the db take
+    turns, so that a window loaded by a worker is not downloaded again by the others. Only the parts of the window
+    that the saved intervals of the station do not cover are downloaded, and the intervals left too close to each other
+    to download what is between them are merged.
     :param station: station code
     :param t0: start timestamp of the timetable
-    :param db: db session
     :return:
     """
-    with tempfile.TemporaryDirectory() as tmp_dirname:
-        downloaded_files = await download_multiple_timetables(station, t0, tmp_dirname)
-        timetables = [parse_timetable(read_json_file(f)) for f in downloaded_files]
-        df = pd.concat([df for df in timetables if df is not None], ignore_index=True).drop_duplicates()
-        update_timetable(station, t0, df, db)
+    async with shared_state.station_lock(station):  # a single worker downloads a station at a time
+        if shared_state.enabled and await run_in_session(IntervalRepo.fetch_including, station, t0) is not None:
+            metrics.inc('timetable_loads_coalesced_total')
+            return  # loaded by another worker while waiting for the lock
+        covered = await run_in_session(lambda db: [itl[:2] for itl in IntervalRepo.fetch_index(db, station).items])
+        starts = plan_windows(t0, covered)
+        metrics.inc('tpt_calls_saved_total', settings.download_concurrency - len(starts))
+        if starts:  # else the saved intervals cover the whole window
+            metrics.inc('timetable_downloads_total')
+            timetables = []
+            async for json_obj in stream_timetables(station, t0, starts):
+                ttb = parse_timetable(json_obj)
+                if ttb is not None:
+                    timetables.append(ttb)
+            if timetables:  # else the station has no departure information at all
+                ttb = ColumnarTimetable.concat(timetables).unique()
+                await run_in_session(lambda db: update_timetable(station, t0, ttb, db), write=True)
+        if has_touching_ranges(t0, covered):  # the gaps too short to download are closed by merging
+            await run_in_session(lambda db: merge_touching_intervals(station, db), write=True)
@@ -4,7 +4,9 @@
 # @Author  : liyun
 # @desc    :
 from datetime import datetime
+from typing import Sequence, Tuple
 from settings import settings
+import numpy as np
 import pytz
 
 tz = pytz.timezone(settings.tz)
@@ -22,10 +24,36 @@ def time_to_seconds(time_str: str, t_ref: int) -> int:
     return seconds if seconds >= t_ref else SECONDS_IN_A_DAY + seconds  # todo: consider t_str=00:00
 
 
+def times_to_seconds(times: Sequence[str or None], t_ref: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized version of time_to_seconds, which converts a whole column of times in hh:mm format at once.
+    :param times: e.g. ['14:20', None, '00:05']
+    :param t_ref: reference time for cross-day conversion
+    :return: int64 seconds of the times since midnight (0 for missing times), and a boolean mask of the valid times
+    """
+    arr = np.array(times, dtype=object)
+    valid = np.not_equal(arr, None)
+    arr[~valid] = '00:00'
+    digits = arr.astype('U5').view(np.uint32).reshape(-1, 5).astype(np.int64) - ord('0')  # one row per time string
+    seconds = (digits[:, 0] * 10 + digits[:, 1]) * 3600 + (digits[:, 3] * 10 + digits[:, 4]) * 60
+    seconds[valid & (seconds < t_ref)] += SECONDS_IN_A_DAY
+    seconds[~valid] = 0
+    return seconds, valid
+
+
 def tptdt_2_timestamp(dt: str) -> int:
     """
     Convert a Transport API style datetime string into timestamp (total seconds since 1970-01-01 UTC)
     :param dt: a Transport API style datetime string e.g. '2022-02-19 14:19'
     :return: timestamp
     """
-    return int(datetime.strptime(dt, '%Y-%m-%d %H:%M').replace(tzinfo=tz).timestamp())
\ No newline at end of file
+    return int(tz.localize(datetime.strptime(dt, '%Y-%m-%d %H:%M')).timestamp())
+
+
+def timestamp_2_tptdt(ts: int) -> str:
+    """
+    Convert a timestamp into a Transport API style datetime string
+    :param ts: timestamp
+    :return: a Transport API style datetime string e.g. '2022-02-19 14:19'
+    """
+    return datetime.fromtimestamp(ts, tz).strftime('%Y-%m-%d %H:%M')
@@ -0,0 +1,114 @@
+"""
+Offline bulk ingest of archived Transport API timetables, e.g. python -m train_app.ingest ./archive --workers 4
+"""
+import argparse
+import json
+import os
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from time import perf_counter
+from typing import Iterator, List, Tuple
+import numpy as np
+from loguru import logger
+from db import SessionLocal, engine
+from train_app.columnar import ColumnarTimetable
+from train_app.etl import parse_timetable, update_timetable
+from train_app.helpers import tptdt_2_timestamp
+from train_app.shared import shared_state
+import train_app.models as models
+
+# (station code, start timestamp, departure, arrival, service, train uids) of a parsed file. The uids are passed as
+# strings as uid codes are only valid in the process that interned them.
+ParsedFile = Tuple[str, int, np.ndarray, np.ndarray, np.ndarray, List[str]]
+
+
+def iter_sources(path: str) -> Iterator[Tuple[str, bytes or None]]:
+    """
+    List the json files in a directory (recursively) or a tarball
+    :param path: the directory or the tarball
+    :return: (file name, content) pairs. The content of files in a directory is None, to be read by the workers.
+    """
+    if os.path.isdir(path):
+        for file in sorted(glob(os.path.join(path, '**', '*.json'), recursive=True)):
+            yield file, None
+        return
+    with tarfile.open(path) as tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith('.json'):
+                yield member.name, tar.extractfile(member).read()
+
+
+def parse_file(source: Tuple[str, bytes or None]) -> ParsedFile or None:
+    """
+    Parse an archived timetable, run in a worker process
+    :param source: (file name, content) pair
+    :return: the parsed file, or None if the file has no departure information
+    """
+    name, content = source
+    if content is None:
+        with open(name, 'rb') as f:
+            content = f.read()
+    json_obj = json.loads(content)
+    ttb = parse_timetable(json_obj)
+    if ttb is None:
+        return None
+    # archived responses are named {station}_{date}_{time}.json, see transport_api.fetch_timetable
+    station = json_obj.get('station_code') or os.path.basename(name).split('_')[0]
+    t0 = tptdt_2_timestamp(f"{json_obj['date']} {json_obj['time_of_day']}")
+    return station.upper(), t0, ttb.departure, ttb.arrival, ttb.service, ttb.train_uids()
+
+
+def ingest(path: str, workers: int = None, batch_size: int = 200) -> dict:
+    """
+    Parse the archived timetables with a process pool, and merge them into the database in batched transactions
+    :param path: a directory or a tarball of json files
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :param batch_size: number of files merged per transaction
+    :return: ingest statistics
+    """
+    models.create_tables(engine)
+    t_start = perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parsed = [p for p in executor.map(parse_file, iter_sources(path), chunksize=16) if p is not None]
+    t_parsed = perf_counter()
+    logger.info(f'Parsed {len(parsed)} timetables in {t_parsed - t_start:.1f}s')
+
+    parsed.sort(key=lambda p: (p[0], p[1]))  # merge each station's windows in time order
+    rows, rows_written, unchanged, db = 0, 0, 0, SessionLocal()
+    try:
+        for i, (station, t0, departure, arrival, service, uids) in enumerate(parsed, 1):
+            ttb = ColumnarTimetable.from_columns(departure, arrival, service, uids)
+            written = update_timetable(station, t0, ttb, db, commit=i % batch_size == 0)
+            rows += len(ttb)
+            rows_written += written
+            unchanged += not written
+        db.commit()
+        shared_state.bump({p[0] for p in parsed})  # bumped again now that all batches are committed
+    finally:
+        db.close()
+    t_end = perf_counter()
+    stats = {'files': len(parsed), 'rows': rows, 'rows_written': rows_written, 'unchanged_files': unchanged,
+             'parse_seconds': t_parsed - t_start,
+             'write_seconds': t_end - t_parsed, 'rows_per_second': rows / max(t_end - t_start, 1e-9)}
+    logger.info(f"Ingested {rows} rows from {len(parsed)} timetables in {t_end - t_start:.1f}s "
+                f"({stats['rows_per_second']:.0f} rows/s), {rows_written} rows written, {unchanged} timetables "
+                f"unchanged")
+    return stats
+
+
+def main():
+    """
+    Ingest archived timetables. A live server sharing the database sees the changed stations through the station
+    versions (see models.StationVersion), and drops its cached journeys at once if it shares SHARED_DIR as well.
+    """
+    parser = argparse.ArgumentParser(description='Load archived Transport API timetables into the database')
+    parser.add_argument('path', help='a directory or a tarball of timetable json files')
+    parser.add_argument('--workers', type=int, default=None, help='number of parsing processes')
+    parser.add_argument('--batch-size', type=int, default=200, help='number of files merged per transaction')
+    args = parser.parse_args()
+    ingest(args.path, args.workers, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+In-memory sorted intervals of the stations, so that interval lookups need no range query
+"""
+from bisect import bisect_left, bisect_right
+from threading import RLock
+from typing import Callable, Iterable, List, Tuple
+
+
+class StationIntervals:
+    """
+    Sorted intervals of a single station. Intervals of a station never overlap (overlapping intervals are merged when
+    timetables are updated), so sorting them by start timestamp also sorts them by stop timestamp.
+    """
+    def __init__(self, intervals: Iterable[Tuple[int, int, int]] = (), version: int = 0):
+        """
+        :param intervals: (start_timestamp, stop_timestamp, id) tuples
+        :param version: version of the intervals of the station in the db when loaded, see StationVersion
+        """
+        self.version = version
+        items = sorted(intervals)
+        # copy-on-write: readers take the (items, starts) pair without locking while the writer swaps in a new one
+        self._data = (items, [itl[0] for itl in items])
+
+    @property
+    def items(self) -> List[Tuple[int, int, int]]:
+        return self._data[0]
+
+    def copy(self) -> 'StationIntervals':
+        return StationIntervals(self.items, self.version)
+
+    def add(self, start: int, stop: int, interval_id: int):
+        items, starts = self._data
+        item = (start, stop, interval_id)
+        i = bisect_left(items, item)
+        if i < len(items) and items[i] == item:  # already added, e.g. loaded from the db
+            return
+        self._data = (items[:i] + [item] + items[i:], starts[:i] + [start] + starts[i:])
+
+    def remove(self, interval_ids: Iterable[int]):
+        ids = set(interval_ids)
+        items = [itl for itl in self.items if itl[2] not in ids]
+        self._data = (items, [itl[0] for itl in items])
+
+    def including(self, val: int) -> int or None:
+        """
+        Return the id of the interval [start, stop] that includes the value
+        """
+        items, starts = self._data
+        i = bisect_right(starts, val) - 1  # the last interval starting at or before val
+        if i >= 0 and items[i][1] >= val:
+            return items[i][2]
+        return None
+
+    def included(self, min_val: int, max_val: int) -> List[int]:
+        """
+        Return the ids of the intervals that are within [min_val, max_val]
+        """
+        items, starts = self._data
+        res = []
+        for start, stop, interval_id in items[bisect_left(starts, min_val):]:
+            if stop > max_val:
+                break
+            res.append(interval_id)
+        return res
+
+
+class IntervalIndex:
+    """
+    In-memory index of the intervals table, loaded lazily per station
+    """
+    def __init__(self):
+        self._stations = {}
+        self._lock = RLock()
+
+    def get(self, station: str, loader: Callable[[], Iterable[Tuple[int, int, int]]],
+            version: int = 0) -> StationIntervals:
+        """
+        Return the sorted intervals of a station, loading them with the loader if not yet indexed or older than the
+        version
+        :param station: station code
+        :param loader: returns all (start_timestamp, stop_timestamp, id) tuples of the station
+        :param version: the version of the intervals of the station in the db, read before calling the loader
+        :return: the sorted intervals
+        """
+        with self._lock:
+            intervals = self._stations.get(station)
+            if intervals is None or intervals.version < version:
+                intervals = self._stations[station] = StationIntervals(loader(), version)
+            return intervals
+
+    def peek(self, station: str) -> StationIntervals or None:
+        """
+        Return the sorted intervals of a station if indexed
+        """
+        with self._lock:
+            return self._stations.get(station)
+
+    def add(self, station: str, start: int, stop: int, interval_id: int):
+        with self._lock:
+            if station in self._stations:  # unloaded stations will pick up the interval when loaded
+                self._stations[station].add(start, stop, interval_id)
+
+    def remove(self, interval_ids: Iterable[int]):
+        ids = list(interval_ids)
+        with self._lock:
+            for intervals in self._stations.values():
+                intervals.remove(ids)
+
+    def bump(self, station: str, version: int):
+        """
+        Move the intervals of a station to the version committed by this process. If another process committed the
+        versions in between, the intervals stay behind, to be reloaded on next access.
+        """
+        with self._lock:
+            intervals = self._stations.get(station)
+            if intervals is not None and intervals.version == version - 1:
+                intervals.version = version
+
+    def invalidate(self, station: str = None):
+        """
+        Drop the index of a station, or of all stations, so that it is reloaded from the db on next access
+        """
+        with self._lock:
+            if station is None:
+                self._stations.clear()
+            else:
+                self._stations.pop(station, None)
+
+
+interval_index = IntervalIndex()
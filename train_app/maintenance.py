@@ -0,0 +1,216 @@
+"""
+Compaction and retention of the stored timetables, e.g. python -m train_app.maintenance --retention-days 2
+"""
+import argparse
+import asyncio
+import os
+from time import time
+from typing import List
+from loguru import logger
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from db import SessionLocal, engine, run_in_session
+from settings import settings
+from train_app.cache import journey_cache, timetable_cache
+from train_app.models import Interval
+from train_app.repositories import ConnectionRepo, FingerprintRepo, IntervalRepo, timetable_repo
+from train_app.schemas import IntervalCreate
+from train_app.shared import shared_state, shared_ttb_cache
+import train_app.models as models
+
+
+def compact_station(db: Session, station: str, gap: int) -> int:
+    """
+    Merge the intervals of a station that touch each other, i.e. where one starts at most `gap` seconds after the
+    previous one stops. The caller commits the transaction.
+    :param db: database session
+    :param station: station code
+    :param gap: largest gap between two intervals to merge, in seconds
+    :return: number of intervals removed
+    """
+    runs: List[List[Interval]] = []
+    stop = None
+    for interval in db.query(Interval).filter(Interval.station_code == station).order_by(Interval.start_timestamp):
+        if runs and interval.start_timestamp <= stop + gap:
+            runs[-1].append(interval)
+            stop = max(stop, interval.stop_timestamp)
+        else:
+            runs.append([interval])
+            stop = interval.stop_timestamp
+    removed = 0
+    for run in runs:
+        if len(run) < 2:
+            continue
+        ids = [i.id for i in run]
+        merged = IntervalRepo.create(db, IntervalCreate(
+            station_code=station, start_timestamp=run[0].start_timestamp,
+            stop_timestamp=max(i.stop_timestamp for i in run)), commit=False)
+        timetable_repo.bulk_move_to_interval(db, ids, merged.id)
+        IntervalRepo.bulk_delete_by_id(db, ids)
+        timetable_cache.invalidate(station, ids)
+        removed += len(run) - 1
+    return removed
+
+
+def evict_before(db: Session, cutoff: int) -> (int, int):
+    """
+    Delete the intervals stopping before the cutoff, and their records. The caller commits the transaction.
+    :param db: database session
+    :param cutoff: timestamp
+    :return: number of intervals and records deleted
+    """
+    intervals = db.query(Interval).filter(Interval.stop_timestamp < cutoff).all()
+    if not intervals:
+        return 0, 0
+    rows = timetable_repo.bulk_delete_by_intervals(db, intervals)
+    IntervalRepo.bulk_delete_by_id(db, [i.id for i in intervals])
+    for station in {i.station_code for i in intervals}:
+        timetable_cache.invalidate(station, [i.id for i in intervals if i.station_code == station])
+    return len(intervals), rows
+
+
+def db_file_size() -> int or None:
+    if engine.dialect.name != 'sqlite' or not engine.url.database:
+        return None
+    return sum(os.path.getsize(f) for f in (engine.url.database, f'{engine.url.database}-wal') if os.path.exists(f))
+
+
+def vacuum() -> int or None:
+    """
+    Reclaim the space of deleted rows
+    :return: bytes reclaimed, if known
+    """
+    size = db_file_size()
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:  # VACUUM can't run in a transaction
+        if engine.dialect.name == 'sqlite':
+            conn.exec_driver_sql('VACUUM')
+            conn.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+        elif engine.dialect.name == 'postgresql':
+            conn.exec_driver_sql('VACUUM ANALYZE')
+    return None if size is None else size - db_file_size()
+
+
+def run_maintenance(db: Session, retention_days: float = None, merge_gap: int = None, reclaim: bool = True) -> dict:
+    """
+    Merge touching intervals, evict the data older than the retention window, and reclaim space
+    :param db: database session
+    :param retention_days: how many past days of data to keep, defaults to settings.retention_days
+    :param merge_gap: largest gap between two intervals to merge, in seconds, defaults to settings.merge_gap
+    :param reclaim: whether to vacuum the database
+    :return: maintenance statistics
+    """
+    retention_days = settings.retention_days if retention_days is None else retention_days
+    merge_gap = settings.merge_gap if merge_gap is None else merge_gap
+    n_intervals = db.query(func.count(Interval.id)).scalar()
+    stations = [s for s, in db.query(Interval.station_code).distinct()]
+    try:
+        cutoff = int(time() - retention_days * 86400)
+        intervals_evicted, rows_evicted = evict_before(db, cutoff)
+        rows_orphaned = timetable_repo.delete_orphans(db)
+        connections_evicted = ConnectionRepo.delete_before(db, cutoff)
+        fingerprints_evicted = FingerprintRepo.delete_before(db, cutoff)
+        intervals_merged = sum(compact_station(db, station, merge_gap) for station in stations)
+        connections_backfilled = ConnectionRepo.backfill(db) if settings.connection_index else 0
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    for station in stations:
+        journey_cache.invalidate(station)
+    shared_state.bump(stations)
+    shared_ttb_cache.prune(settings.ttb_cache_ttl)
+    stats = {'stations': len(stations), 'intervals': n_intervals, 'intervals_evicted': intervals_evicted,
+             'intervals_merged': intervals_merged, 'rows_evicted': rows_evicted, 'rows_orphaned': rows_orphaned,
+             'connections_evicted': connections_evicted, 'connections_backfilled': connections_backfilled,
+             'fingerprints_evicted': fingerprints_evicted,
+             'bytes_reclaimed': vacuum() if reclaim else None}
+    logger.info(f'Maintenance: {stats}')
+    return stats
+
+
+def backfill_connections(db: Session) -> int:
+    """
+    Index the connections of the timetables saved while the connection index was off, in a single transaction
+    :param db: database session
+    :return: number of intervals indexed
+    """
+    try:
+        indexed = ConnectionRepo.backfill(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    if indexed:
+        logger.info(f'Indexed the connections of {indexed} intervals')
+    return indexed
+
+
+class MaintenanceJob:
+    """
+    Run the maintenance periodically, in the db writer thread
+    """
+    def __init__(self):
+        self._tasks = []
+
+    def start(self):
+        self._tasks.append(asyncio.ensure_future(self.run()))
+
+    def start_backfill(self):
+        """
+        Index the connections of the timetables saved while the connection index was off, in the background
+        """
+        self._tasks.append(asyncio.ensure_future(self.backfill()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @staticmethod
+    async def backfill():
+        try:
+            await run_in_session(backfill_connections, write=True)
+        except Exception as e:
+            logger.warning(f'Connection backfill failed: {e!r}')
+
+    @staticmethod
+    def run_once(db: Session):
+        if not shared_state.enabled:
+            return run_maintenance(db)
+        with shared_state.file_lock('maintenance', blocking=False) as locked:
+            if locked:  # otherwise, another worker is running it
+                return run_maintenance(db)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(settings.maintenance_interval * 3600)
+            try:
+                await run_in_session(self.run_once, write=True)
+            except Exception as e:
+                logger.warning(f'Maintenance failed: {e!r}')
+
+
+maintenance_job = MaintenanceJob()
+
+
+def main():
+    """
+    Run the maintenance once, e.g. from cron. A live server sharing the database sees the changes through the station
+    versions (see models.StationVersion), so SHARED_DIR is not required.
+    """
+    parser = argparse.ArgumentParser(description='Compact the stored timetables and evict the old ones')
+    parser.add_argument('--retention-days', type=float, default=None, help='past days of data to keep')
+    parser.add_argument('--merge-gap', type=int, default=None, help='largest gap between intervals to merge (s)')
+    parser.add_argument('--no-vacuum', action='store_true', help='do not reclaim the space of deleted rows')
+    args = parser.parse_args()
+    models.create_tables(engine)
+    db = SessionLocal()
+    try:
+        run_maintenance(db, args.retention_days, args.merge_gap, not args.no_vacuum)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
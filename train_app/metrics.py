@@ -0,0 +1,180 @@
+"""
+Per-stage latency histograms and counters, exported in the Prometheus text format
+"""
+from asyncio import iscoroutinefunction
+from bisect import bisect_left
+from contextlib import nullcontext
+from contextvars import ContextVar
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, Tuple
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from settings import settings
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# time spent per stage by the current request, as stage -> [seconds, calls], used for the Server-Timing header
+request_timings: ContextVar[Dict[str, list] or None] = ContextVar('request_timings', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket is +Inf
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Timer:
+    """
+    Context manager recording the duration of its block
+    """
+    __slots__ = ('metrics', 'stage', 't')
+
+    def __init__(self, metrics: 'Metrics', stage: str):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.t = perf_counter()
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, perf_counter() - self.t)
+
+
+NULL_TIMER = nullcontext()
+
+
+class Metrics:
+    """
+    Registry of the stage latencies and event counts of the application
+    """
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.stages: Dict[str, Histogram] = {}
+        self.counters: Dict[Tuple[str, Tuple], float] = {}  # (name, sorted labels) -> value
+        self.gauges: Dict[str, Callable[[], dict]] = {}  # name -> function returning {label value: value}
+        self._lock = Lock()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            hist = self.stages.get(stage)
+            if hist is None:
+                hist = self.stages[stage] = Histogram()
+            hist.observe(seconds)
+        timings = request_timings.get()
+        if timings is not None:
+            timing = timings.setdefault(stage, [0., 0])
+            timing[0] += seconds
+            timing[1] += 1
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def register_gauge(self, name: str, fn: Callable[[], dict]):
+        """
+        Register values read at scrape time, e.g. cache statistics
+        :param name: metric name
+        :param fn: a function returning {label value: value}
+        """
+        self.gauges[name] = fn
+
+    def timer(self, stage: str):
+        """
+        Return a context manager recording the duration of its block, which does nothing when the metrics are disabled
+        :param stage: name of the stage
+        """
+        return Timer(self, stage) if self.enabled else NULL_TIMER
+
+    def timed(self, stage: str):
+        """
+        Decorator recording the duration of each call of a function or coroutine function. The function is returned
+        as is when the metrics are disabled, so that disabled timers cost nothing.
+        :param stage: name of the stage
+        """
+        def decorator(fn):
+            if not self.enabled:
+                return fn
+            if iscoroutinefunction(fn):
+                @wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    t = perf_counter()
+                    try:
+                        return await fn(*args, **kwargs)
+                    finally:
+                        self.observe(stage, perf_counter() - t)
+                return async_wrapper
+
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                t = perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(stage, perf_counter() - t)
+            return wrapper
+        return decorator
+
+    def instrument_engine(self, engine: Engine):
+        """
+        Time every query run by the engine, as the db_query stage
+        """
+        if not self.enabled:
+            return
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('query_start', []).append(perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            self.observe('db_query', perf_counter() - conn.info['query_start'].pop())
+
+    def render(self) -> str:
+        """
+        Export the metrics in the Prometheus text format
+        """
+        lines = ['# TYPE stage_seconds histogram']
+        with self._lock:
+            for stage, hist in sorted(self.stages.items()):
+                cumulative = 0
+                for le, n in zip(list(hist.buckets) + ['+Inf'], hist.counts):
+                    cumulative += n
+                    lines.append(f'stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'stage_seconds_sum{{stage="{stage}"}} {hist.sum}')
+                lines.append(f'stage_seconds_count{{stage="{stage}"}} {hist.count}')
+            counters = sorted(self.counters.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+            label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f'{name}{{{label_str}}} {value}' if label_str else f'{name} {value}')
+        for name, fn in sorted(self.gauges.items()):
+            lines.append(f'# TYPE {name} gauge')
+            for label, value in fn().items():
+                lines.append(f'{name}{{name="{label}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def server_timing(timings: Dict[str, list]) -> str:
+    """
+    Format the time spent per stage as a Server-Timing header value
+    """
+    return ', '.join(f'{stage};dur={seconds * 1000:.2f};desc="{calls} calls"'
+                     for stage, (seconds, calls) in timings.items())
+
+
+metrics = Metrics(settings.metrics_enabled)
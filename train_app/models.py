@@ -3,7 +3,9 @@
 # @Time    : 2022/7/30 10:46
 # @Author  : liyun
 # @desc    :
-from sqlalchemy import Column, ForeignKey, Integer, String, Float
+from typing import List
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, Float, UniqueConstraint, inspect, text
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from db import Base, APPTZ
@@ -15,20 +17,130 @@ class Interval(Base):
     station_code = Column(String(3), nullable=False)
     start_timestamp = Column(Integer)
     stop_timestamp = Column(Integer)
+    # bumped whenever the records of the interval change, as cached timetables are keyed by id and version
+    version = Column(Integer, nullable=False, default=0, server_default='0')
     timetables = relationship("Timetable", primaryjoin="Interval.id == Timetable.interval_id", cascade="all, delete")
+    __table_args__ = (
+        Index('ix_intervals_station_start_stop', 'station_code', 'start_timestamp', 'stop_timestamp'),
+        Index('ix_intervals_station_stop', 'station_code', 'stop_timestamp'),
+    )
 
 
 class Timetable(Base):
     __tablename__ = "timetables"
 
     id = Column(Integer, primary_key=True, index=True)
+    station_code = Column(String(3), nullable=False)
     service = Column(Integer)
     train_uid = Column(String(20), nullable=False)
     aimed_departure_timestamp = Column(Integer)
     aimed_arrival_timestamp = Column(Integer)
-    interval_id = Column(Integer, ForeignKey('intervals.id'), nullable=False)
+    # aimed departure, or aimed arrival for trains terminating at the station. Identifies a stop of a train
+    event_timestamp = Column(Integer, nullable=False)
+    interval_id = Column(Integer, ForeignKey('intervals.id'), nullable=False, index=True)
+    __table_args__ = (
+        UniqueConstraint('station_code', 'train_uid', 'event_timestamp', name='uq_timetables_stop'),
+        Index('ix_timetables_train_uid_event', 'train_uid', 'event_timestamp'),
+    )
 
     def __repr__(self):
         return f'{self.station_code} {self.train_uid} {datetime.fromtimestamp(self.aimed_arrival_timestamp, tz=APPTZ)}'
 
 
+
+
+class Connection(Base):
+    """
+    A train running from a station to another one, for every pair of stations whose timetables both have the train
+    """
+    __tablename__ = "connections"
+
+    id = Column(Integer, primary_key=True)
+    from_station = Column(String(3), nullable=False)
+    to_station = Column(String(3), nullable=False)
+    train_uid = Column(String(20), nullable=False)
+    departure_timestamp = Column(Integer, nullable=False)
+    arrival_timestamp = Column(Integer, nullable=False)
+    __table_args__ = (
+        UniqueConstraint('from_station', 'to_station', 'train_uid', 'departure_timestamp', name='uq_connections'),
+        # the earliest arrival departing after a time is the first row of a range scan
+        Index('ix_connections_pair_arrival', 'from_station', 'to_station', 'arrival_timestamp'),
+    )
+
+
+class Fingerprint(Base):
+    """
+    Digest of the last timetable merged for a station and window, so that unchanged timetables are not merged again
+    """
+    __tablename__ = "fingerprints"
+
+    id = Column(Integer, primary_key=True)
+    station_code = Column(String(3), nullable=False)
+    start_timestamp = Column(Integer, nullable=False)
+    digest = Column(String(32), nullable=False)
+    __table_args__ = (
+        UniqueConstraint('station_code', 'start_timestamp', name='uq_fingerprints_window'),
+    )
+
+
+class StationVersion(Base):
+    """
+    Version of the intervals of a station, bumped by every transaction changing them, so that the processes sharing the
+    db know when their in-memory index of the station is stale
+    """
+    __tablename__ = "station_versions"
+
+    station_code = Column(String(3), primary_key=True)
+    version = Column(Integer, nullable=False)
+
+
+# columns added to the tables of earlier versions: (table, column, definition, expression filling the existing rows)
+ADDED_COLUMNS = [
+    ('timetables', 'station_code', "VARCHAR(3) NOT NULL DEFAULT ''",
+     '(SELECT intervals.station_code FROM intervals WHERE intervals.id = timetables.interval_id)'),
+    ('timetables', 'event_timestamp', 'INTEGER NOT NULL DEFAULT -1',
+     'CASE WHEN aimed_departure_timestamp != -1 THEN aimed_departure_timestamp ELSE aimed_arrival_timestamp END'),
+    ('intervals', 'version', 'INTEGER NOT NULL DEFAULT 0', '0'),
+]
+
+
+def create_tables(bind: Engine) -> List[str]:
+    """
+    Create the missing tables, and upgrade the tables of a database created by an earlier version: add the missing
+    columns and indexes, and the unique constraint of the timetable stops once duplicate stops are removed. create_all
+    alone leaves existing tables unchanged. Safe to run on every start.
+    :param bind: the db engine
+    :return: the upgrade steps applied
+    """
+    Base.metadata.create_all(bind=bind)
+    steps = []
+    with bind.begin() as conn:
+        inspector = inspect(conn)
+        for table, column, definition, fill in ADDED_COLUMNS:
+            if column not in {c['name'] for c in inspector.get_columns(table)}:
+                conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {definition}'))
+                conn.execute(text(f'UPDATE {table} SET {column} = {fill}'))
+                steps.append(f'add {table}.{column}')
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            existing = index_names(inspector, table.name)
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(conn)
+                    steps.append(f'create {index.name}')
+        if 'uq_timetables_stop' not in index_names(inspector, 'timetables'):
+            conn.execute(text('DELETE FROM timetables WHERE id NOT IN '
+                              '(SELECT MAX(id) FROM timetables GROUP BY station_code, train_uid, event_timestamp)'))
+            conn.execute(text('CREATE UNIQUE INDEX uq_timetables_stop ON timetables '
+                              '(station_code, train_uid, event_timestamp)'))
+            steps.append('create uq_timetables_stop')
+    return steps
+
+
+
+def index_names(inspector, table: str) -> set:
+    """
+    Names of the indexes and unique constraints of a table in the db
+    """
+    return {i['name'] for i in inspector.get_indexes(table)} | \
+        {c['name'] for c in inspector.get_unique_constraints(table)}
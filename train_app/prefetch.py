@@ -0,0 +1,148 @@
+"""
+Demand-driven background prefetch of the timetables of popular stations
+"""
+import asyncio
+from math import exp, log
+from threading import Lock
+from time import time
+from typing import Iterable, List, Tuple
+from loguru import logger
+from sqlalchemy.orm import Session
+from db import run_in_session
+from settings import settings
+from train_app.etl import load_timetable
+from train_app.repositories import IntervalRepo
+from train_app.transport_api import TokenBucket
+
+
+class DemandTracker:
+    """
+    Exponentially decayed query counts of stations
+    """
+    def __init__(self, half_life: float):
+        """
+        :param half_life: time for a query to lose half of its weight, in seconds
+        """
+        self.decay = log(2) / half_life
+        self.scores = {}  # station -> (score, time of the score)
+        self._lock = Lock()
+
+    def record(self, stations: Iterable[str], now: float = None):
+        now = time() if now is None else now
+        with self._lock:
+            for station in stations:
+                score, t = self.scores.get(station, (0., now))
+                self.scores[station] = (score * exp(-self.decay * (now - t)) + 1, now)
+
+    def top(self, n: int, now: float = None) -> List[str]:
+        """
+        Return the n most queried stations
+        """
+        now = time() if now is None else now
+        with self._lock:
+            scores = {s: score * exp(-self.decay * (now - t)) for s, (score, t) in self.scores.items()}
+            scores = {s: score for s, score in scores.items() if score > 0.01}  # forget cold stations
+            self.scores = {s: (score, now) for s, score in scores.items()}
+            return sorted(scores, key=lambda s: -scores[s])[:n]
+
+
+class PrefetchScheduler:
+    """
+    Keep the upcoming timetables of the most queried stations loaded ahead of time, within a budget of API calls
+    """
+    def __init__(self):
+        self.tracker = DemandTracker(settings.prefetch_half_life)
+        self.limiter = TokenBucket(settings.prefetch_calls_per_minute / 60, settings.download_concurrency)
+        self.queue = None
+        self.queued = set()  # keys of the windows in the queue, see window_key
+        self.loaded = 0
+        self.dropped = 0
+        self._tasks = []
+
+    def record(self, stations: Iterable[str]):
+        self.tracker.record(stations)
+
+    @staticmethod
+    def window_key(window: Tuple[str, int]) -> Tuple[str, int]:
+        """
+        Identify a window by its station and the start of its single flight window, like load_timetable, as the first
+        window of a station starts at the time of planning
+        """
+        station, t = window
+        return station, t - t % settings.single_flight_window
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=settings.prefetch_queue_size)
+        self._tasks = [asyncio.ensure_future(self.plan()), asyncio.ensure_future(self.work())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def windows_to_load(self, db: Session, now: float) -> List[tuple]:
+        """
+        Return the (station, start timestamp) windows of the hottest stations that are not loaded yet
+        """
+        span = settings.download_concurrency * settings.t_window * 3600  # reach of a single download
+        res = []
+        for station in self.tracker.top(settings.prefetch_top_n, now):
+            t = int(now)
+            while t < now + settings.prefetch_lookahead * 3600:
+                interval = IntervalRepo.fetch_including(db, station, t)
+                if interval is None:
+                    res.append((station, t))
+                    t += span
+                else:
+                    t = interval.stop_timestamp + 1
+        return res
+
+    def enqueue(self, windows: Iterable[Tuple[str, int]]):
+        """
+        Queue the (station, start timestamp) windows that are not queued yet, dropping them if the queue is full
+        """
+        for window in windows:
+            key = self.window_key(window)
+            if key in self.queued:
+                continue
+            try:
+                self.queue.put_nowait(window)
+                self.queued.add(key)
+            except asyncio.QueueFull:
+                self.dropped += 1
+
+    async def plan(self):
+        """
+        Periodically queue the windows to load
+        """
+        while True:
+            try:
+                self.enqueue(await run_in_session(self.windows_to_load, time()))
+            except Exception as e:
+                logger.warning(f'Failed to plan the prefetch: {e!r}')
+            await asyncio.sleep(settings.prefetch_interval)
+
+    async def work(self):
+        """
+        Load the queued windows within the API call budget
+        """
+        while True:
+            station, t = await self.queue.get()
+            try:
+                for _ in range(settings.download_concurrency):  # calls made by a single load
+                    await self.limiter.acquire()
+                await load_timetable(station, t)
+                self.loaded += 1
+            except Exception as e:
+                logger.warning(f'Failed to prefetch {station} at {t}: {e!r}')
+            finally:
+                self.queued.discard(self.window_key((station, t)))
+                self.queue.task_done()
+
+    def stats(self) -> dict:
+        return {'queued': self.queue.qsize() if self.queue is not None else 0, 'loaded': self.loaded,
+                'dropped': self.dropped, 'hot_stations': self.tracker.top(settings.prefetch_top_n)}
+
+
+prefetch_scheduler = PrefetchScheduler()
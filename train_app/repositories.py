@@ -3,22 +3,55 @@
 # @Time    : 2022/7/31 10:13
 # @Author  : liyun
 # @desc    :
-from typing import List
-import pandas as pd
-from models import Interval, Timetable
-from sqlalchemy.orm import Session
-from sqlalchemy import delete
-from schemas import IntervalCreate, TimetableCreate
+from typing import Dict, Iterable, List
+from db import NAT
+from settings import settings
+from train_app.models import Connection, Fingerprint, Interval, StationVersion, Timetable
+from sqlalchemy.orm import Session, SessionTransaction
+from sqlalchemy import delete, event, exists, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from train_app.schemas import IntervalCreate, TimetableCreate
+from train_app.cache import journey_cache, timetable_cache
+from train_app.interval_index import interval_index, StationIntervals
+from train_app.columnar import ColumnarTimetable, uid_interner
+from train_app.csa import pair_connections
+from train_app.metrics import metrics
+from train_app.shared import shared_state
+
+
+PENDING_INTERVALS = 'pending_intervals'  # session info key of the interval changes not committed yet
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_pending_intervals(db: Session):
+    """
+    Apply the interval changes of a transaction to the shared index once committed, so that other sessions never see
+    uncommitted intervals
+    """
+    for op, *args in db.info.pop(PENDING_INTERVALS, []):
+        getattr(interval_index, op)(*args)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def drop_pending_intervals(db: Session, transaction: SessionTransaction):
+    if transaction.parent is None:  # rolled back, or already applied on commit
+        db.info.pop(PENDING_INTERVALS, None)
 
 
 class IntervalRepo:
     @staticmethod
-    def create(db: Session, interval: IntervalCreate):
+    def create(db: Session, interval: IntervalCreate, commit: bool = True):
         db_interval = Interval(station_code=interval.station_code, start_timestamp=interval.start_timestamp,
                                stop_timestamp=interval.stop_timestamp)
         db.add(db_interval)
-        db.commit()
-        db.refresh(db_interval)
+        db.flush()  # to get the id
+        db.info.setdefault(PENDING_INTERVALS, []).append(
+            ('add', db_interval.station_code, db_interval.start_timestamp, db_interval.stop_timestamp,
+             db_interval.id))
+        IntervalRepo.bump_versions(db, [db_interval.station_code])
+        if commit:
+            db.commit()
+            db.refresh(db_interval)
         return db_interval
 
     @staticmethod
@@ -29,7 +62,69 @@ class IntervalRepo:
     def fetch_by_station(db: Session, station: str):
         return db.query(Interval).filter(Interval.station_code == station)
 
+    @staticmethod
+    def fetch_version(db: Session, station: str) -> int:
+        return db.scalar(select(StationVersion.version).where(StationVersion.station_code == station)) or 0
+
+    @staticmethod
+    def bump_versions(db: Session, stations: Iterable[str]):
+        """
+        Bump the versions of the stations whose intervals the transaction changes, so that the processes sharing the
+        db reload them. The caller commits the transaction, the index is updated on commit.
+        """
+        insert = postgresql.insert if db.bind.dialect.name == 'postgresql' else sqlite.insert
+        pending = db.info.setdefault(PENDING_INTERVALS, [])
+        for station in sorted(set(stations)):
+            stmt = insert(StationVersion).values(station_code=station, version=1)
+            db.execute(stmt.on_conflict_do_update(index_elements=['station_code'],
+                                                  set_={'version': StationVersion.version + 1}))
+            pending.append(('bump', station, IntervalRepo.fetch_version(db, station)))
+
+    @staticmethod
+    def invalidate(station: str):
+        """
+        Drop the in-memory index and caches of a station, e.g. changed by another process
+        """
+        interval_index.invalidate(station)
+        timetable_cache.invalidate(station)
+        journey_cache.invalidate(station)
+
     @classmethod
+    def fetch_index(cls, db: Session, station: str) -> StationIntervals:
+        """
+        Return the in-memory sorted intervals of a station, loading them from the db on first access, or when another
+        process changed them (see StationVersion)
+        :param db: database session
+        :param station: station code
+        :return: the sorted intervals
+        """
+        shared_state.sync(station)  # another worker may have changed the intervals of the station
+
+        def load():
+            return db.query(Interval.start_timestamp, Interval.stop_timestamp, Interval.id).filter(
+                Interval.station_code == station)
+
+        version = cls.fetch_version(db, station)
+        intervals = interval_index.peek(station)
+        pending = db.info.get(PENDING_INTERVALS)
+        if not pending:
+            if intervals is not None and intervals.version < version:  # changed by another process
+                cls.invalidate(station)
+            return interval_index.get(station, load, version)
+        # the session sees its own uncommitted changes, on top of the shared index
+        bumps = [args[1] for op, *args in pending if op == 'bump' and args[0] == station]
+        if intervals is None or intervals.version != (bumps[0] - 1 if bumps else version):
+            return StationIntervals(load(), version)  # the query sees the uncommitted changes already
+        intervals = intervals.copy()
+        for op, *args in pending:
+            if op == 'add' and args[0] == station:
+                intervals.add(*args[1:])
+            elif op == 'remove':
+                intervals.remove(*args)
+        return intervals
+
+    @classmethod
+    @metrics.timed('interval_lookup')
     def fetch_including(cls, db: Session, station: str, val: int) -> Interval or None:
         """
         Return the interval that includes the value.
@@ -38,10 +133,18 @@ class IntervalRepo:
         :param val: the value in the interval
         :return:
         """
-        return cls.fetch_by_station(db, station)\
-            .filter(Interval.start_timestamp < val, Interval.stop_timestamp >= val).first()
+        interval_id = cls.fetch_index(db, station).including(val)
+        if interval_id is None:
+            return None
+        interval = db.get(Interval, interval_id)
+        if interval is None:  # deleted without bumping the version, e.g. by an earlier version of the app
+            cls.invalidate(station)
+            interval_id = cls.fetch_index(db, station).including(val)
+            interval = None if interval_id is None else db.get(Interval, interval_id)
+        return interval
 
     @classmethod
+    @metrics.timed('interval_lookup')
     def fetch_included(cls, db: Session, station: str, min_val: int, max_val: int):
         """
         Return all intervals that are within the range specified by min_val and max_val
@@ -51,39 +154,57 @@ class IntervalRepo:
         :param max_val: max value
         :return: all intervals
         """
-        return cls.fetch_by_station(db, station)\
-            .filter(Interval.start_timestamp > min_val, Interval.stop_timestamp <= max_val)
+        ids = cls.fetch_index(db, station).included(min_val, max_val)
+        return db.query(Interval).filter(Interval.id.in_(ids))
 
     @staticmethod
     def update(db: Session, interval_data):
         updated_interval = db.merge(interval_data)
+        IntervalRepo.bump_versions(db, [updated_interval.station_code])
         db.commit()
+        interval_index.invalidate(updated_interval.station_code)
         return updated_interval
 
+    @staticmethod
+    def revise(db: Session, interval: Interval, start: int = None, stop: int = None):
+        """
+        Record a change to the records of an interval, and extend its time range if given. The version of the interval
+        is bumped, so that the timetables cached under its previous version are never read again. The caller commits
+        the transaction, the index is updated on commit.
+        :param db: database session
+        :param interval: the interval
+        :param start: new start timestamp
+        :param stop: new stop timestamp
+        :return:
+        """
+        interval.version = Interval.version + 1
+        if start is not None and stop is not None:
+            interval.start_timestamp, interval.stop_timestamp = start, stop
+            pending = db.info.setdefault(PENDING_INTERVALS, [])
+            pending.append(('remove', [interval.id]))
+            pending.append(('add', interval.station_code, start, stop, interval.id))
+            IntervalRepo.bump_versions(db, [interval.station_code])
+        db.flush()
+
     @staticmethod
     def bulk_delete_by_id(db: Session, ids: List[int]):
+        """
+        Delete intervals. The caller commits the transaction, the index is updated on commit.
+        """
+        IntervalRepo.bump_versions(db, db.scalars(select(Interval.station_code).where(Interval.id.in_(ids))))
         db.execute(delete(Interval).where(Interval.id.in_(ids)))
+        db.info.setdefault(PENDING_INTERVALS, []).append(('remove', list(ids)))
 
 
 class TimetableRepo:
     @staticmethod
     def make_timetable(ttb: TimetableCreate) -> Timetable:
         return Timetable(
-            service=ttb.service, train_uid=ttb.train_uid, aimed_departure_timestamp=ttb.aimed_departure_timestamp,
-            aimed_arrival_timestamp=ttb.aimed_arrival_timestamp, interval_id=ttb.interval_id)
-
-    @staticmethod
-    def make_ttb_dicts_by_df(df_ttb: pd.DataFrame, include_id: bool) -> List[dict]:
-        """
-        Make a list of timetable dictionary by a pandas dataframe
-        :param df_ttb: the dataframe
-        :param include_id: whether id is included in the dicts
-        :return: the list of dicts
-        """
-        cols = ['service', 'train_uid', 'aimed_departure_timestamp', 'aimed_arrival_timestamp', 'interval_id']
-        if include_id:
-            cols.append('id')
-        return df_ttb[cols].to_dict(orient='records')
+            station_code=ttb.station_code, service=ttb.service, train_uid=ttb.train_uid,
+            aimed_departure_timestamp=ttb.aimed_departure_timestamp,
+            aimed_arrival_timestamp=ttb.aimed_arrival_timestamp, interval_id=ttb.interval_id,
+            event_timestamp=ttb.aimed_departure_timestamp if ttb.aimed_departure_timestamp != NAT
+            else ttb.aimed_arrival_timestamp)
 
     @classmethod
     def create(cls, db: Session, ttb: TimetableCreate):
@@ -93,18 +214,224 @@ class TimetableRepo:
         db.refresh(db_timetable)
         return db_timetable
 
-    @classmethod
-    def bulk_insert_by_df(cls, db: Session, df_ttb: pd.DataFrame):
-        db.bulk_save_objects([Timetable(**ttb) for ttb in cls.make_ttb_dicts_by_df(df_ttb, include_id=False)])
+    @staticmethod
+    @metrics.timed('timetable_write')
+    def bulk_upsert(db: Session, station: str, interval_id: int, ttb: ColumnarTimetable) -> int:
+        """
+        Insert the records of a timetable, or update the existing records of the same train stops that differ
+        (INSERT ... ON CONFLICT DO UPDATE ... WHERE). The caller commits the transaction.
+        :param db: database session
+        :param station: station code
+        :param interval_id: id of the interval the records belong to
+        :param ttb: the timetable
+        :return: number of records written
+        """
+        if not len(ttb):
+            return 0
+        columns = ('service', 'aimed_departure_timestamp', 'aimed_arrival_timestamp', 'interval_id')
+        insert = postgresql.insert if db.bind.dialect.name == 'postgresql' else sqlite.insert
+        stmt = insert(Timetable.__table__)  # a core statement, whose result has the number of rows written
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['station_code', 'train_uid', 'event_timestamp'],
+            set_={col: stmt.excluded[col] for col in columns},
+            where=or_(*[getattr(Timetable, col).is_distinct_from(stmt.excluded[col]) for col in columns]))
+        event = ttb.event_timestamps()
+        return db.execute(stmt, [
+            {'station_code': station, 'service': service, 'train_uid': uid, 'aimed_departure_timestamp': dept,
+             'aimed_arrival_timestamp': arr, 'event_timestamp': ev, 'interval_id': interval_id}
+            for service, uid, dept, arr, ev in zip(ttb.service.tolist(), ttb.train_uids(), ttb.departure.tolist(),
+                                                   ttb.arrival.tolist(), event.tolist())]).rowcount
 
-    @classmethod
-    def bulk_update_by_df(cls, db: Session, df_ttb: pd.DataFrame):
-        db.bulk_update_mappings(Timetable, cls.make_ttb_dicts_by_df(df_ttb, include_id=True))
+    @staticmethod
+    def bulk_move_to_interval(db: Session, ids: List[int], interval_id: int):
+        """
+        Re-point all records of the intervals to another interval. The caller commits the transaction.
+        :param db: database session
+        :param ids: ids of the intervals to move records from
+        :param interval_id: id of the interval to move records to
+        :return: number of records moved
+        """
+        stmt = update(Timetable).where(Timetable.interval_id.in_(ids)).values(interval_id=interval_id)
+        return db.execute(stmt).rowcount
+
+    @staticmethod
+    def bulk_delete_by_intervals(db: Session, intervals: List[Interval]) -> int:
+        """
+        Delete all records of the intervals. The caller commits the transaction.
+        :param db: database session
+        :param intervals: the intervals
+        :return: number of records deleted
+        """
+        return db.execute(delete(Timetable).where(Timetable.interval_id.in_([i.id for i in intervals]))).rowcount
+
+    @staticmethod
+    def delete_orphans(db: Session) -> int:
+        """
+        Delete the records whose interval no longer exists. The caller commits the transaction.
+        :param db: database session
+        :return: number of records deleted
+        """
+        return db.execute(delete(Timetable).where(Timetable.interval_id.not_in(select(Interval.id)))).rowcount
 
     @staticmethod
     def fetch_by_interval_id(db: Session, interval_id: int):
         return db.query(Timetable).filter(Timetable.interval_id == interval_id)
 
+    @staticmethod
+    @metrics.timed('timetable_read')
+    def fetch_columnar_by_interval_id(db: Session, interval_id: int) -> ColumnarTimetable:
+        """
+        Load the timetable of an interval with a plain Core SELECT, without building ORM objects
+        :param db: database session
+        :param interval_id: interval id
+        :return: the columnar timetable
+        """
+        return ColumnarTimetable.from_rows(db.execute(
+            select(Timetable.aimed_departure_timestamp, Timetable.aimed_arrival_timestamp, Timetable.service,
+                   Timetable.train_uid).where(Timetable.interval_id == interval_id)).all())
+
+    @staticmethod
+    def fetch_columnar_by_train_uids(db: Session, uids: List[str], t0: int, t1: int,
+                                     exclude_station: str = None) -> Dict[str, ColumnarTimetable]:
+        """
+        Load the records of some trains at all stations, within a time range
+        :param db: database session
+        :param uids: train uids
+        :param t0: min event timestamp
+        :param t1: max event timestamp
+        :param exclude_station: station whose records are not loaded
+        :return: the timetable of each station the trains stop at
+        """
+        rows = db.execute(
+            select(Timetable.station_code, Timetable.aimed_departure_timestamp, Timetable.aimed_arrival_timestamp,
+                   Timetable.service, Timetable.train_uid)
+            .where(Timetable.train_uid.in_(uids), Timetable.event_timestamp.between(t0, t1),
+                   Timetable.station_code != exclude_station)).all()
+        by_station = {}
+        for row in rows:
+            by_station.setdefault(row[0], []).append(row[1:])
+        return {station: ColumnarTimetable.from_rows(station_rows) for station, station_rows in by_station.items()}
+
     @staticmethod
     def fetch_by_multiple_interval_ids(db: Session, ids: List[int]):
         return db.query(Timetable).filter(Timetable.interval_id.in_(ids)).all()
+
+
+class ConnectionRepo:
+    @staticmethod
+    @metrics.timed('connection_write')
+    def bulk_upsert(db: Session, station: str, ttb: ColumnarTimetable) -> int:
+        """
+        Index the connections, in both directions, between a station and the stations sharing trains with its new
+        records. The caller commits the transaction.
+        :param db: database session
+        :param station: station code
+        :param ttb: the new records of the station
+        :return: number of connections indexed
+        """
+        if not len(ttb):
+            return 0
+        event = ttb.event_timestamps()
+        others = timetable_repo.fetch_columnar_by_train_uids(
+            db, sorted(set(ttb.train_uids())), int(event.min()) - settings.max_single_journey,
+            int(event.max()) + settings.max_single_journey, exclude_station=station)
+        rows = []
+        for other, other_ttb in others.items():
+            for from_station, from_ttb, to_station, to_ttb in ((station, ttb, other, other_ttb),
+                                                               (other, other_ttb, station, ttb)):
+                uid, departure, arrival = pair_connections(from_ttb, to_ttb)
+                rows += [{'from_station': from_station, 'to_station': to_station, 'train_uid': u,
+                          'departure_timestamp': d, 'arrival_timestamp': a}
+                         for u, d, a in zip(uid_interner.lookup(uid.tolist()), departure.tolist(), arrival.tolist())]
+        if rows:
+            insert = postgresql.insert if db.bind.dialect.name == 'postgresql' else sqlite.insert
+            stmt = insert(Connection)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['from_station', 'to_station', 'train_uid', 'departure_timestamp'],
+                set_={'arrival_timestamp': stmt.excluded.arrival_timestamp},
+                where=Connection.arrival_timestamp != stmt.excluded.arrival_timestamp)
+            db.execute(stmt, rows)
+        return len(rows)
+
+    @staticmethod
+    def backfill(db: Session) -> int:
+        """
+        Index the connections of the saved intervals that have none departing within them, e.g. saved while the index
+        was off. The caller commits the transaction.
+        :param db: database session
+        :return: number of intervals indexed
+        """
+        intervals = db.query(Interval).filter(~exists().where(
+            Connection.from_station == Interval.station_code,
+            Connection.departure_timestamp.between(Interval.start_timestamp, Interval.stop_timestamp))).all()
+        for interval in intervals:
+            ConnectionRepo.bulk_upsert(db, interval.station_code,
+                                       timetable_repo.fetch_columnar_by_interval_id(db, interval.id))
+        return len(intervals)
+
+    @staticmethod
+    @metrics.timed('connection_read')
+    def fetch_earliest_arrival(db: Session, from_station: str, to_station: str, t_dept: int, max_departure: int,
+                               max_arrival: int) -> Connection or None:
+        """
+        Return the connection arriving first among the ones departing within a time range, with a range scan of the
+        (from_station, to_station, arrival_timestamp) index
+        :param db: database session
+        :param from_station: code of the departure station
+        :param to_station: code of the arrival station
+        :param t_dept: min departure timestamp
+        :param max_departure: max departure timestamp
+        :param max_arrival: max arrival timestamp
+        :return: the connection, or None
+        """
+        return db.query(Connection).filter(
+            Connection.from_station == from_station, Connection.to_station == to_station,
+            Connection.arrival_timestamp.between(t_dept, max_arrival),
+            Connection.departure_timestamp.between(t_dept, max_departure)
+        ).order_by(Connection.arrival_timestamp, Connection.departure_timestamp).first()
+
+    @staticmethod
+    def delete_before(db: Session, cutoff: int) -> int:
+        """
+        Delete the connections arriving before the cutoff. The caller commits the transaction.
+        :return: number of connections deleted
+        """
+        return db.execute(delete(Connection).where(Connection.arrival_timestamp < cutoff)).rowcount
+
+
+class FingerprintRepo:
+    @staticmethod
+    def fetch(db: Session, station: str, start: int) -> str or None:
+        """
+        Return the digest of the last timetable merged for a station and window, if any
+        """
+        return db.query(Fingerprint.digest).filter(Fingerprint.station_code == station,
+                                                   Fingerprint.start_timestamp == start).scalar()
+
+    @staticmethod
+    def upsert(db: Session, station: str, start: int, digest: str):
+        """
+        Record the digest of the timetable merged for a station and window. The caller commits the transaction.
+        """
+        insert = postgresql.insert if db.bind.dialect.name == 'postgresql' else sqlite.insert
+        stmt = insert(Fingerprint).values(station_code=station, start_timestamp=start, digest=digest)
+        db.execute(stmt.on_conflict_do_update(index_elements=['station_code', 'start_timestamp'],
+                                              set_={'digest': stmt.excluded.digest}))
+
+    @staticmethod
+    def delete_before(db: Session, cutoff: int) -> int:
+        """
+        Delete the digests of the windows starting before the cutoff. The caller commits the transaction.
+        :return: number of digests deleted
+        """
+        return db.execute(delete(Fingerprint).where(Fingerprint.start_timestamp < cutoff)).rowcount
+
+
+# the repo the timetable records are written to and read from, see settings.timetable_backend
+if settings.timetable_backend == 'arrow':
+    from train_app.arrow_store import ArrowTimetableRepo, pa
+    if pa is None:
+        raise ImportError('The arrow timetable backend requires pyarrow, install it with `pip install pyarrow`')
+    timetable_repo = ArrowTimetableRepo
+else:
+    timetable_repo = TimetableRepo
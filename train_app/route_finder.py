@@ -3,67 +3,318 @@
 # @Time    : 2022/7/30 16:50
 # @Author  : liyun
 # @desc    :
-from typing import List
+from asyncio import gather, Semaphore
+from typing import AsyncIterator, Iterable, List, Tuple
 from sqlalchemy.orm import Session
-from models import Timetable
-from schemas import SingleJourney
-import pandas as pd
+from db import NAT, run_in_session
+from train_app.models import Timetable
+from train_app.schemas import SingleJourney
+import numpy as np
 from settings import settings
-from repositories import IntervalRepo, TimetableRepo
-from etl import load_timetable
+from train_app.repositories import ConnectionRepo, IntervalRepo, timetable_repo
+from train_app.etl import load_timetable
+from train_app.cache import timetable_cache
+from train_app.columnar import ColumnarTimetable, uid_interner
+from train_app.csa import build_connections, Connections, earliest_connections, join_first_arrival, \
+    pair_connections, scan_earliest_arrival, suffix_best
+from train_app.metrics import metrics
+from train_app.shared import shared_ttb_cache
 
 
 class RouteFinder:
-    def __init__(self, db: Session):
-        self.db = db
-
-    def get_saved_timetable(self, station: str, t0: int) -> pd.DataFrame or None:
+    """
+    Route search. The db is only accessed through run_in_session, so that queries never block the event loop.
+    """
+    @staticmethod
+    def fetch_saved_timetable(db: Session, station: str, t0: int) -> ColumnarTimetable or None:
         """
         Get timetable data already saved in the db
+        :param db: database session
         :param station: station code
         :param t0: the time of interest
         :return: timetable data, or None if data not previously saved
         """
-        interval = IntervalRepo.fetch_including(self.db, station, t0)
+        interval = IntervalRepo.fetch_including(db, station, t0)
         if interval is None:
             return None
-        return pd.DataFrame(TimetableRepo.fetch_by_interval_id(self.db, interval.id))
+        key = (station, interval.id, interval.version)
+        ttb = timetable_cache.get(key)
+        metrics.inc('timetable_cache_total', result='miss' if ttb is None else 'hit')
+        if ttb is None:
+            shared_key = (station, interval.id, interval.version, interval.start_timestamp, interval.stop_timestamp)
+            ttb = shared_ttb_cache.get(*shared_key)  # loaded by another worker
+            if ttb is None:
+                ttb = timetable_repo.fetch_columnar_by_interval_id(db, interval.id)
+                shared_ttb_cache.put(*shared_key, ttb)
+            timetable_cache.put(key, ttb)
+        return ttb
+
+    async def get_saved_timetable(self, station: str, t0: int) -> ColumnarTimetable or None:
+        return await run_in_session(self.fetch_saved_timetable, station, t0)
+
+    @staticmethod
+    def fetch_missing_windows(db: Session, windows: Iterable[Tuple[str, int]]) -> List[Tuple[str, int]]:
+        """
+        Return the (station, time of interest) pairs that are not saved yet. Times of a station close enough to be
+        covered by one download are grouped, so each timetable is loaded once.
+        """
+        span = settings.download_concurrency * settings.t_window * 3600 // 2  # safe reach of a single download
+        res = []
+        for station, t0 in sorted(set(windows)):
+            if res and res[-1][0] == station and t0 - res[-1][1] <= span:
+                continue  # loaded together with the previous window of the station
+            if IntervalRepo.fetch_including(db, station, t0) is None:
+                res.append((station, t0))
+        return res
+
+    async def prefetch(self, stations: List[str], t0: int):
+        """
+        Concurrently load the timetables of all stations that are not saved yet for the time of interest, so that the
+        leg-by-leg search mostly runs against saved data
+        :param stations: a list of station codes
+        :param t0: the time of interest
+        :return:
+        """
+        await self.prefetch_windows([(s, t0) for s in stations])
+
+    async def prefetch_windows(self, windows: Iterable[Tuple[str, int]]):
+        """
+        Concurrently load the timetables of all (station, time of interest) pairs that are not saved yet. Times of a
+        station close enough to be covered by one download are grouped, so each timetable is loaded once.
+        :param windows: (station code, time of interest) pairs
+        :return:
+        """
+        to_load = await run_in_session(self.fetch_missing_windows, list(windows))
+        semaphore = Semaphore(settings.prefetch_concurrency)
+
+        async def load(station: str, t: int):
+            async with semaphore:
+                await load_timetable(station, t)
 
+        # best effort: a failed load is retried, and its error raised, when the search needs the timetable
+        await gather(*[load(s, t) for s, t in to_load], return_exceptions=True)
 
-    async def search_routes(self, stations: List[str], start_time: int, max_waiting: int) -> List[SingleJourney]:
+    async def extend_timetable(self, station: str, t0: int, t1: int) -> bool:
+        """
+        Load the next window of a station if its saved timetable starting from t0 does not cover t1
+        :param station: station code
+        :param t0: the time of interest
+        :param t1: the time the timetable needs to cover
+        :return: whether more data has been loaded
+        """
+        interval = await run_in_session(IntervalRepo.fetch_including, station, t0)
+        if interval is None or interval.stop_timestamp >= t1:
+            return False
+        stop = interval.stop_timestamp
+        await load_timetable(station, stop)
+        interval = await run_in_session(IntervalRepo.fetch_including, station, t0)
+        return interval is not None and interval.stop_timestamp > stop
+
+    async def search_routes(self, stations: List[str], start_time: int, max_waiting: int,
+                            engine: str = None) -> List[SingleJourney]:
         """
         Search the optimal routes connecting the given list of stations
         :param stations: a list of station codes
         :param start_time: timestamp of the start time
         :param max_waiting: the maximum time the passenger is willing to wait (in minutes)
+        :param engine: 'merge' to join the timetables leg by leg, 'csa' for the connection scan algorithm, or 'index'
+        to look up the connection index leg by leg. Defaults to the route_engine setting
         :return: the arrival timestamp
         """
+        engine = engine or settings.route_engine
+        if engine == 'index' and not settings.connection_index:
+            raise RuntimeError('The connection index is not built, set CONNECTION_INDEX=true')
+        await self.prefetch(stations, start_time)
+        if engine == 'csa':
+            return await self.search_routes_csa(stations, start_time, max_waiting)
         res = []  # contains individual routes from the start to end stations
         t_dept = start_time  # ideal departure time of passenger
         for i in range(len(stations) - 1):
             dept_station, target_station = stations[i:i + 2]
-            df_dept, dept_downloaded = await self.get_timetable(dept_station, t_dept)
-            df_target, target_downloaded = await self.get_timetable(target_station, t_dept)
-            route = self.find_single_route(df_dept, df_target, t_dept)
-            if route is None:
-                if dept_downloaded and target_downloaded:
+            while True:
+                if engine == 'index':
+                    route = await self.find_indexed_route(dept_station, target_station, t_dept)
+                else:
+                    df_dept, _ = await self.get_timetable(dept_station, t_dept)
+                    df_target, _ = await self.get_timetable(target_station, t_dept)
+                    route = self.find_single_route(df_dept, df_target, dept_station, target_station, t_dept)
+                if route is not None:
+                    break
+                # the leg may spill past the saved data, try to load more data
+                t_last_dept = t_dept + max_waiting * 60
+                dept_extended = await self.extend_timetable(dept_station, t_dept, t_last_dept)
+                target_extended = await self.extend_timetable(target_station, t_dept,
+                                                              t_last_dept + settings.max_single_journey)
+                if not dept_extended and not target_extended:
                     raise NotImplementedError(f'Unable to find a route between {dept_station} and {target_station}')
-                if not dept_downloaded:
-                    await load_timetable(dept_station, t_dept, self.db)  # try to load more data
-                    df_dept, dept_downloaded = await self.get_timetable(dept_station, t_dept)
-                if not target_downloaded:
-                    await load_timetable(target_station, t_dept, self.db)
-                    df_target, target_downloaded = await self.get_timetable(target_station, t_dept)
-            route = self.find_single_route(df_dept, df_target, t_dept)  # retry with more data
-            if route.departure_timestamp - start_time > max_waiting:
+            if route.departure_timestamp - t_dept > max_waiting * 60:
                 raise ValueError('Wait time too long')
             t_dept = route.arrival_timestamp
             res.append(route)
         return res
 
+    async def search_batch(self, queries: List[Tuple[List[str], int, int]]) -> List[List[SingleJourney] or Exception]:
+        """
+        Search the optimal routes of many queries. The timetables needed by all queries are loaded first, grouped by
+        station and time window, then the routes are searched in one pass.
+        :param queries: (stations, start_time, max_waiting) of each query, see search_routes
+        :return: the routes of each query in input order, or the exception raised by the query
+        """
+        await self.prefetch_windows((s, start_time) for stations, start_time, _ in queries for s in stations)
+        res = []
+        for stations, start_time, max_waiting in queries:
+            try:
+                res.append(await self.search_routes(stations, start_time, max_waiting))
+            except Exception as e:
+                res.append(e)
+        return res
+
+    async def search_routes_csa(self, stations: List[str], start_time: int, max_waiting: int) -> List[SingleJourney]:
+        """
+        Search the optimal routes connecting the given list of stations with the connection scan algorithm, which
+        finds the earliest arrival across all legs in one scan
+        :param stations: a list of station codes
+        :param start_time: timestamp of the start time
+        :param max_waiting: the maximum time the passenger is willing to wait (in minutes)
+        :return: the arrival timestamp
+        """
+        while True:
+            timetables = [(await self.get_timetable(s, start_time))[0] for s in stations]
+            with metrics.timer('route_find'):
+                conns = build_connections(timetables, start_time)
+                earliest, taken = scan_earliest_arrival(conns, len(stations), start_time)
+            if taken[-1] != -1:
+                break
+            # the route may spill past the saved data, try to load more data for the first unreachable leg
+            i = taken.index(-1, 1) - 1
+            t_last_dept = earliest[i] + max_waiting * 60
+            dept_extended = await self.extend_timetable(stations[i], start_time, t_last_dept)
+            target_extended = await self.extend_timetable(stations[i + 1], start_time,
+                                                          t_last_dept + settings.max_single_journey)
+            if not dept_extended and not target_extended:
+                raise NotImplementedError(f'Unable to find a route between {stations[i]} and {stations[i + 1]}')
+
+        res = []
+        for i in range(len(stations) - 1):
+            c = taken[i + 1]
+            if conns.departure[c] - earliest[i] > max_waiting * 60:
+                raise ValueError('Wait time too long')
+            res.append(SingleJourney.parse_obj({
+                'train_uid': uid_interner.uids[conns.uid[c]],
+                'departure_station': stations[i],
+                'destination_station': stations[i + 1],
+                'departure_timestamp': conns.departure[c],
+                'arrival_timestamp': conns.arrival[c]
+            }))
+        return res
+
+    async def get_leg_connections(self, leg: int, dept_station: str, target_station: str, t0: int) -> Connections:
+        """
+        Load the connections of a leg departing from t0 on, within the saved timetables
+        :param leg: index of the leg
+        :param dept_station: code of the departure station
+        :param target_station: code of the target station
+        :param t0: earliest departure
+        :return: the connections sorted by departure
+        """
+        dept_ttb, _ = await self.get_timetable(dept_station, t0)
+        target_ttb, _ = await self.get_timetable(target_station, t0)
+        uid, departure, arrival = pair_connections(dept_ttb.departures_from(t0), target_ttb)
+        return Connections(np.full(len(departure), leg), departure, arrival, uid)
+
+    async def search_profile_chunk(self, stations: List[str], t_from: int, t_to: int, max_waiting: int,
+                                   times: np.ndarray = None) -> List[Tuple[int, List[SingleJourney] or Exception]]:
+        """
+        Search the optimal routes for many start times at once: the connections of each leg are loaded once, and
+        the arrival profile of the leg is computed in a single backward sweep, see suffix_best
+        :param stations: a list of station codes
+        :param t_from: earliest start time
+        :param t_to: latest start time
+        :param max_waiting: the maximum time the passenger is willing to wait (in minutes)
+        :param times: the start times within [t_from, t_to], or None for the departure times of the first leg, only
+        keeping the journeys that leave at their start time
+        :return: the routes of each start time in order, or the exception raised for it
+        """
+        max_wait = max_waiting * 60
+        starts = ready = times
+        taken = []  # the connections of each leg, and the index of the one taken at each start time
+        failed = None  # the exception raised for each start time, if any
+        for i in range(len(stations) - 1):
+            if i == 0:
+                t_first, t_last = t_from, t_to + max_wait
+            else:
+                active = ready[[e is None for e in failed]]
+                if not len(active):
+                    break
+                t_first, t_last = int(active.min()), int(active.max()) + max_wait
+            while True:
+                conns = await self.get_leg_connections(i, stations[i], stations[i + 1], t_first)
+                with metrics.timer('route_find'):
+                    if times is None and i == 0:  # every departure of the first leg
+                        starts = ready = np.unique(conns.departure[(conns.departure >= t_from) &
+                                                                   (conns.departure <= t_to)])
+                    idx = earliest_connections(conns.departure, suffix_best(conns.arrival), ready)
+                    if times is None and i == 0:  # a journey leaving later is listed at its own departure
+                        keep = conns.departure[idx] == starts
+                        starts, ready, idx = starts[keep], ready[keep], idx[keep]
+                    if failed is None:
+                        failed = [None] * len(starts)
+                if all(e is not None for e, k in zip(failed, idx) if k == -1):
+                    break
+                # some legs may spill past the saved data, try to load more data
+                dept_extended = await self.extend_timetable(stations[i], t_first, t_last)
+                target_extended = await self.extend_timetable(stations[i + 1], t_first,
+                                                              t_last + settings.max_single_journey)
+                if not dept_extended and not target_extended:
+                    break
+            found = idx != -1
+            departure = np.where(found, conns.departure[idx] if len(conns) else 0, 0)
+            for k in np.flatnonzero(~found | (departure - ready > max_wait)).tolist():
+                if failed[k] is None:
+                    failed[k] = ValueError('Wait time too long') if found[k] else NotImplementedError(
+                        f'Unable to find a route between {stations[i]} and {stations[i + 1]}')
+            taken.append((conns, idx))
+            ready = np.where(found, conns.arrival[idx] if len(conns) else 0, ready)
+        res = []
+        for k, error in enumerate(failed):
+            if error is not None:
+                res.append((int(starts[k]), error))
+                continue
+            res.append((int(starts[k]), [SingleJourney.parse_obj({
+                'train_uid': uid_interner.uids[conns.uid[idx[k]]],
+                'departure_station': stations[i],
+                'destination_station': stations[i + 1],
+                'departure_timestamp': conns.departure[idx[k]],
+                'arrival_timestamp': conns.arrival[idx[k]]
+            }) for i, (conns, idx) in enumerate(taken)]))
+        return res
+
+    async def search_profile(self, stations: List[str], t_from: int, t_to: int, max_waiting: int,
+                             step: int = None) -> AsyncIterator[List[Tuple[int, List[SingleJourney] or Exception]]]:
+        """
+        Search the optimal routes for all start times of a range, one time window after the other, so that memory
+        stays flat whatever the range
+        :param stations: a list of station codes
+        :param t_from: earliest start time
+        :param t_to: latest start time
+        :param max_waiting: the maximum time the passenger is willing to wait (in minutes)
+        :param step: seconds between two start times, or None for every departure of the first station, only
+        keeping the journeys that leave at their start time
+        :return: an async iterator of the routes of the start times of each window, see search_profile_chunk
+        """
+        await self.prefetch(stations, t_from)
+        chunk = settings.t_window * 3600
+        for t0 in range(t_from, t_to + 1, chunk):
+            t1 = min(t0 + chunk - 1, t_to)
+            times = None if step is None else np.arange(t0 + (t_from - t0) % step, t1 + 1, step)
+            if times is not None and not len(times):
+                continue
+            yield await self.search_profile_chunk(stations, t0, t1, max_waiting, times)
+
     @staticmethod
-    def find_single_route(dept_ttb: pd.DataFrame,
-                          target_ttb: pd.DataFrame,
+    @metrics.timed('route_find')
+    def find_single_route(dept_ttb: ColumnarTimetable,
+                          target_ttb: ColumnarTimetable,
                           dept_station: str,
                           target_station: str,
                           t_dept: int) -> SingleJourney or None:
@@ -76,33 +327,79 @@ class RouteFinder:
         :param t_dept: departing time
         :return: the fastest route, or None
         """
-        df_merged = dept_ttb.merge(target_ttb, how='inner', on='train_uid', suffixes=('_d', '_a'))
-        if not len(df_merged):  # no train connection
+        dept_ttb = dept_ttb.departures_from(t_dept)
+        target_ttb = target_ttb.take(target_ttb.arrival != NAT)
+        # the train must reach the target after leaving the departure station, on the same day
+        idx, arrival = join_first_arrival(dept_ttb.uid, dept_ttb.departure, target_ttb.uid, target_ttb.arrival,
+                                          settings.max_single_journey)
+        if not len(idx):  # no train connection
             return None
-        best_route = df_merged.sort_values('aimed_arrival_timestamp_a').iloc[0]
+        best = np.argmin(arrival)
         return SingleJourney.parse_obj({
-            'train_uid': best_route['train_uid_a'],
+            'train_uid': uid_interner.uids[dept_ttb.uid[idx[best]]],
             'departure_station': dept_station,
             'destination_station': target_station,
-            'departure_timestamp': best_route['departure_timestamp_a'],
-            'arrival_timestamp': best_route['arrival_timestamp_a']
+            'departure_timestamp': dept_ttb.departure[idx[best]],
+            'arrival_timestamp': arrival[best]
         })
 
-    async def get_timetable(self, station: str, t0: int) -> (pd.DataFrame, bool):
+    @staticmethod
+    def fetch_indexed_route(db: Session, dept_station: str, target_station: str,
+                            t_dept: int) -> (SingleJourney or None, List[str]):
+        """
+        Find the fastest route connecting departure and target stations with a lookup of the connection index,
+        among the trains of the saved timetables including the departing time, as find_single_route
+        :param db: database session
+        :param dept_station: code of the departure station
+        :param target_station: code of the target station
+        :param t_dept: departing time
+        :return: the fastest route or None, and the stations whose timetable is not saved yet
+        """
+        dept_interval = IntervalRepo.fetch_including(db, dept_station, t_dept)
+        target_interval = IntervalRepo.fetch_including(db, target_station, t_dept)
+        missing = [s for s, i in ((dept_station, dept_interval), (target_station, target_interval)) if i is None]
+        if missing:
+            return None, missing
+        conn = ConnectionRepo.fetch_earliest_arrival(db, dept_station, target_station, t_dept,
+                                                     dept_interval.stop_timestamp, target_interval.stop_timestamp)
+        if conn is None:
+            return None, []
+        return SingleJourney.parse_obj({
+            'train_uid': conn.train_uid,
+            'departure_station': dept_station,
+            'destination_station': target_station,
+            'departure_timestamp': conn.departure_timestamp,
+            'arrival_timestamp': conn.arrival_timestamp
+        }), []
+
+    async def find_indexed_route(self, dept_station: str, target_station: str, t_dept: int) -> SingleJourney or None:
+        """
+        Find the fastest route connecting departure and target stations with the connection index, loading the
+        timetables of the stations first if needed
+        """
+        route, missing = await run_in_session(self.fetch_indexed_route, dept_station, target_station, t_dept)
+        if missing:
+            await gather(*[load_timetable(station, t_dept) for station in missing])
+            route, missing = await run_in_session(self.fetch_indexed_route, dept_station, target_station, t_dept)
+            if missing:
+                raise RuntimeError('Unable to get data from API server')
+        return route
+
+    async def get_timetable(self, station: str, t0: int) -> (ColumnarTimetable, bool):
         """
         Load **CONTIGUOUS** timetable data from db i.e data sharing the same window_id, given t0 and t1
         :param station: station code
         :param t0: the start timestamp of the timetable
         :return: the dataframe, and a variable indicating whether data has been downloaded
         """
-        df = self.get_saved_timetable(station, t0)
-        if df is not None:
-            return df, False
+        ttb = await self.get_saved_timetable(station, t0)
+        if ttb is not None:
+            return ttb, False
 
-        await load_timetable(station, t0, self.db)
-        df = self.get_saved_timetable(station, t0)
-        if df is None:
+        await load_timetable(station, t0)
+        ttb = await self.get_saved_timetable(station, t0)
+        if ttb is None:
             raise RuntimeError('Unable to get data from API server')
-        return df, True
+        return ttb, True
 
 
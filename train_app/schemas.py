@@ -3,11 +3,12 @@
 # @Time    : 2022/7/30 16:00
 # @Author  : liyun
 # @desc    :
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel
 
 
 class TimetableBase(BaseModel):
+    station_code: str
     service: int
     train_uid: str
     aimed_departure_timestamp: int
@@ -63,3 +64,21 @@ class SingleJourneyOutput(SingleJourneyBase):
 class Journey(BaseModel):
     summary: str
     routes: List[SingleJourneyOutput]
+
+
+class ArrivalQuery(BaseModel):
+    stations: List[str]
+    date: str
+    start_time: str
+    max_waiting: Optional[int] = None
+
+
+class ArrivalResult(BaseModel):
+    journey: Optional[Journey] = None
+    error: Optional[str] = None
+
+
+class ArrivalProfilePoint(BaseModel):
+    start_time: str
+    journey: Optional[Journey] = None
+    error: Optional[str] = None
@@ -0,0 +1,196 @@
+"""
+Coordination of several worker processes sharing a database, through files of a shared folder (settings.shared_dir,
+ideally on a tmpfs such as /dev/shm)
+"""
+import fcntl
+import os
+import shutil
+import uuid
+import zlib
+from asyncio import get_running_loop
+from contextlib import asynccontextmanager, contextmanager
+from threading import Lock
+from time import time
+from typing import Iterable
+import numpy as np
+from settings import settings
+from train_app.cache import journey_cache, timetable_cache
+from train_app.columnar import ColumnarTimetable, uid_interner
+from train_app.interval_index import interval_index
+
+N_SLOTS = 1 << 16  # station versions slots, stations sharing a slot just invalidate each other more often
+
+
+class SharedState:
+    """
+    Per station versions, bumped by any process changing the intervals of a station, so that the other processes drop
+    their in-memory index and caches of the station. Also provides cross-process locks.
+    """
+    def __init__(self, shared_dir: str):
+        """
+        :param shared_dir: the shared folder, coordination is disabled if empty
+        """
+        self.enabled = bool(shared_dir)
+        self.dir = shared_dir
+        self.seen = {}  # station -> version this process is in sync with
+        self._versions = None
+        self._lock = Lock()
+
+    @property
+    def versions(self) -> np.ndarray:
+        if self._versions is None:
+            os.makedirs(os.path.join(self.dir, 'locks'), exist_ok=True)
+            path = os.path.join(self.dir, 'versions')
+            with self.file_lock('versions'):
+                if not os.path.exists(path):
+                    np.zeros(N_SLOTS, dtype=np.int64).tofile(path)
+            self._versions = np.memmap(path, dtype=np.int64, mode='r+', shape=(N_SLOTS,))
+        return self._versions
+
+    @staticmethod
+    def slot(station: str) -> int:
+        return zlib.crc32(station.encode()) % N_SLOTS
+
+    @contextmanager
+    def file_lock(self, name: str, blocking: bool = True):
+        """
+        Hold an exclusive lock shared by all processes. Yields whether the lock is held, which is always the case
+        when blocking.
+        """
+        with open(os.path.join(self.dir, 'locks', f'{name}.lock'), 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @asynccontextmanager
+    async def station_lock(self, station: str):
+        """
+        Hold the download lock of a station, waiting for it in a thread so as not to block the event loop
+        """
+        if not self.enabled:
+            yield
+            return
+        os.makedirs(os.path.join(self.dir, 'locks'), exist_ok=True)
+        f = open(os.path.join(self.dir, 'locks', f'station_{station}.lock'), 'a')
+        try:
+            await get_running_loop().run_in_executor(None, fcntl.flock, f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        finally:
+            f.close()
+
+    def bump(self, stations: Iterable[str]):
+        """
+        Tell the other processes that this process changed the intervals of the stations
+        """
+        if not self.enabled:
+            return
+        versions = self.versions
+        with self.file_lock('versions'), self._lock:
+            for station in stations:
+                slot = self.slot(station)
+                old = int(versions[slot])
+                versions[slot] = old + 1
+                # this process is still in sync only if no other process changed the station in the meantime
+                if self.seen.get(station, 0) == old:
+                    self.seen[station] = old + 1
+
+    def sync(self, station: str):
+        """
+        Drop the in-memory index and caches of a station if another process changed its intervals
+        """
+        if not self.enabled:
+            return
+        version = int(self.versions[self.slot(station)])
+        with self._lock:
+            if self.seen.get(station, 0) == version:
+                return
+            self.seen[station] = version
+        interval_index.invalidate(station)
+        timetable_cache.invalidate(station)
+        journey_cache.invalidate(station)
+
+
+class SharedTimetableCache:
+    """
+    Timetables loaded by any process, saved as numpy files that the other processes memory-map instead of querying
+    the db. The departure, arrival and service columns are read without copy. Train uids are saved as strings, as
+    uid codes are only valid in the process that interned them.
+    """
+    def __init__(self, shared_dir: str):
+        self.enabled = bool(shared_dir)
+        self.dir = os.path.join(shared_dir, 'timetables')
+
+    def path(self, station: str, interval_id: int, version: int, start: int, stop: int) -> str:
+        # the version and time range are part of the key, so that the records of an interval rewritten in place, or an
+        # id reused by the db, never read stale data
+        return os.path.join(self.dir, f'{station}_{interval_id}_{version}_{start}_{stop}')
+
+    def get(self, station: str, interval_id: int, version: int, start: int, stop: int) -> ColumnarTimetable or None:
+        if not self.enabled:
+            return None
+        path = self.path(station, interval_id, version, start, stop)
+        try:
+            columns = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+                       for name in ('departure', 'arrival', 'service', 'uid_index')}
+            uids = np.load(os.path.join(path, 'uids.npy'))
+        except FileNotFoundError:
+            return None
+        codes = uid_interner.intern(uids.tolist())[columns['uid_index']] if len(uids) else np.empty(0, np.int32)
+        return ColumnarTimetable(columns['departure'], columns['arrival'], columns['service'], codes, is_sorted=True)
+
+    def put(self, station: str, interval_id: int, version: int, start: int, stop: int, ttb: ColumnarTimetable):
+        if not self.enabled:
+            return
+        path = self.path(station, interval_id, version, start, stop)
+        if os.path.exists(path):
+            return
+        tmp_path = os.path.join(self.dir, f'.{uuid.uuid4().hex}')
+        os.makedirs(tmp_path)
+        codes, uid_index = np.unique(ttb.uid, return_inverse=True)
+        np.save(os.path.join(tmp_path, 'departure.npy'), ttb.departure)
+        np.save(os.path.join(tmp_path, 'arrival.npy'), ttb.arrival)
+        np.save(os.path.join(tmp_path, 'service.npy'), ttb.service)
+        np.save(os.path.join(tmp_path, 'uid_index.npy'), uid_index.astype(np.int32))
+        np.save(os.path.join(tmp_path, 'uids.npy'), np.array(uid_interner.lookup(codes.tolist()), dtype=str))
+        try:
+            os.rename(tmp_path, path)  # atomic, readers see either no entry or a complete one
+        except OSError:  # saved by another process in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def invalidate(self, station: str, interval_id: int):
+        """
+        Remove the entries of an interval whose records changed
+        """
+        if not self.enabled or not os.path.isdir(self.dir):
+            return
+        for name in os.listdir(self.dir):
+            if name.startswith(f'{station}_{interval_id}_'):
+                shutil.rmtree(os.path.join(self.dir, name), ignore_errors=True)
+
+    def prune(self, max_age: float) -> int:
+        """
+        Remove the entries older than max_age seconds
+        :return: number of entries removed
+        """
+        if not self.enabled or not os.path.isdir(self.dir):
+            return 0
+        removed = 0
+        for name in os.listdir(self.dir):
+            path = os.path.join(self.dir, name)
+            if os.path.getmtime(path) < time() - max_age:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        return removed
+
+
+shared_state = SharedState(settings.shared_dir)
+shared_ttb_cache = SharedTimetableCache(settings.shared_dir)
@@ -0,0 +1,34 @@
+"""
+Coalescing of concurrent calls for the same key into a single call
+"""
+from asyncio import ensure_future, shield, Task
+from typing import Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls sharing the same key: only the first call runs, the others await its result
+    """
+    def __init__(self):
+        self._calls: Dict[Hashable, Task] = {}
+
+    def __contains__(self, key: Hashable):
+        return key in self._calls
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key: Hashable, fn: Callable[..., Awaitable], *args):
+        """
+        Run fn(*args), unless a call with the same key is already in flight, in which case its result is returned
+        :param key: key of the call
+        :param fn: the coroutine function
+        :param args: arguments of fn
+        :return: the result of the call
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = ensure_future(fn(*args))
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        # a cancelled caller must not cancel the call the others are waiting for
+        return await shield(task)
@@ -4,54 +4,291 @@
 # @Author  : liyun
 # @desc    :
 from datetime import datetime
-from typing import List
+from typing import AsyncIterator, Iterable, List, Tuple
+from collections import deque
+from time import monotonic, perf_counter
+import random
 
 from db import NAT
 import pytz
 from sqlalchemy.orm import Session
 from settings import settings
-from asyncio import gather
+from asyncio import as_completed, ensure_future, get_running_loop, Lock, sleep
 import pandas as pd
 import httpx
-from helpers import time_to_seconds, tptdt_2_timestamp
-from models import Interval
+from train_app.helpers import time_to_seconds, tptdt_2_timestamp
+from train_app.metrics import metrics
+from train_app.models import Interval
 import json
 import os
 
 
-async def download_timetable(station: str, date_str: str, time_str: str, file_path: str, client) -> str:
+class TokenBucket:
     """
-    Download timetable data using Transport API, and save the data in a json file
-    :param station: station code
-    :param date_str: date in string format e.g. '2022-02-09'
-    :param time_str: time in string format e.g. '14:17'
+    Token bucket rate limiter: up to `capacity` calls can be made in a burst, refilled at `rate` calls per second
+    """
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = monotonic()
+        self._lock = None
+        self._loop = None
+
+    async def acquire(self):
+        if self.rate <= 0:  # unlimited
+            return
+        loop = get_running_loop()
+        if self._loop is not loop:  # an asyncio lock cannot be shared across event loops
+            self._lock, self._loop = Lock(), loop
+        async with self._lock:  # waiters are served in order
+            while True:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await sleep((1 - self.tokens) / self.rate)
+
+
+class LatencyStats:
+    """
+    Latency of the recent API calls
+    """
+    def __init__(self, size: int = 1000):
+        self.latencies = deque(maxlen=size)
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+
+    def record(self, latency: float):
+        self.calls += 1
+        self.latencies.append(latency)
+
+    def summary(self) -> dict:
+        res = {'calls': self.calls, 'retries': self.retries, 'errors': self.errors}
+        if self.latencies:
+            lat = sorted(self.latencies)
+            res.update({'mean': sum(lat) / len(lat), 'p50': lat[len(lat) // 2],
+                        'p95': lat[min(int(len(lat) * 0.95), len(lat) - 1)], 'max': lat[-1]})
+        return res
+
+
+class TransportApiClient:
+    """
+    Application-lifetime client of the Transport API, which reuses connections from a pool, keeps the call rate within
+    the API quota, and retries throttled or failed calls with exponential backoff
+    """
+    def __init__(self, transport: httpx.AsyncBaseTransport = None):
+        """
+        :param transport: transport of the http client, e.g. an httpx.MockTransport in tests. Defaults to the network
+        """
+        self.limiter = TokenBucket(settings.tpt_rate_limit, settings.tpt_burst)
+        self.stats = LatencyStats()
+        self.transport = transport
+        self._client = None
+        self._loop = None
+        self._closing = set()  # clients of previous event loops being closed
+
+    @staticmethod
+    async def close_quietly(client: httpx.AsyncClient):
+        """
+        Close a client of a previous event loop, whose connections may not be closable any more
+        """
+        try:
+            await client.aclose()
+        except Exception:
+            pass
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        loop = get_running_loop()
+        if self._client is None or self._loop is not loop:  # a pool cannot be shared across event loops
+            if self._client is not None:
+                task = ensure_future(self.close_quietly(self._client))
+                self._closing.add(task)
+                task.add_done_callback(self._closing.discard)
+            limits = httpx.Limits(max_connections=settings.tpt_max_connections,
+                                  max_keepalive_connections=settings.tpt_max_connections)
+            self._client = httpx.AsyncClient(limits=limits, timeout=settings.tpt_timeout, transport=self.transport)
+            self._loop = loop
+        return self._client
+
+    @staticmethod
+    def backoff(attempt: int, res: httpx.Response = None) -> float:
+        """
+        Return the seconds to wait before the next attempt, honouring the Retry-After header if any, up to the timeout
+        of a call
+        """
+        retry_after = res.headers.get('Retry-After') if res is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), settings.tpt_timeout)
+        return settings.tpt_retry_backoff * 2 ** attempt * (1 + random.random() / 2)
+
+    @metrics.timed('download')
+    async def get_json(self, url: str, params: dict) -> dict:
+        """
+        GET a json object
+        :param url: url of the API
+        :param params: query parameters
+        :return: the json object
+        """
+        for attempt in range(settings.tpt_max_retries + 1):
+            await self.limiter.acquire()
+            t0 = perf_counter()
+            try:
+                res = await self.client.get(url, params=params)
+            except httpx.TransportError:
+                metrics.inc('tpt_calls_total', status='error')
+                if attempt == settings.tpt_max_retries:
+                    self.stats.errors += 1
+                    raise
+                self.stats.retries += 1
+                await sleep(self.backoff(attempt))
+                continue
+            self.stats.record(perf_counter() - t0)
+            metrics.inc('tpt_calls_total', status=res.status_code)
+            if (res.status_code == 429 or res.status_code >= 500) and attempt < settings.tpt_max_retries:
+                self.stats.retries += 1
+                await sleep(self.backoff(attempt, res))
+                continue
+            if res.is_error:
+                self.stats.errors += 1
+            res.raise_for_status()
+            return res.json()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+tpt_client = TransportApiClient()
+
+
+def window_starts(t0: int) -> List[int]:
+    """
+    Return the start timestamps of the timetables to download. The number is determined by the concurrency settings
+    :param t0: start timestamp
+    :return: a list of timestamps, one t_window apart
+    """
+    return [t0 + i * settings.t_window * 3600 for i in range(settings.download_concurrency)]
+
+
+def window_datetimes(t0: int, starts: List[int] = None) -> List[datetime]:
+    """
+    Return the start times of the timetables to download
+    :param t0: start timestamp
+    :param starts: start timestamps of the timetables, defaults to window_starts(t0)
+    :return: a list of datetimes
+    """
+    starts = window_starts(t0) if starts is None else starts
+    return [datetime.fromtimestamp(t, pytz.timezone(settings.tz)) for t in starts]
+
+
+def plan_windows(t0: int, covered: Iterable[Tuple[int, int]], gap: int = None) -> List[int]:
+    """
+    Plan the timetables to download so as to cover [t0, t0 + download_concurrency * t_window) except the ranges
+    already covered, with as few API calls as possible: each call covers t_window from the first uncovered time,
+    so that gaps closer than t_window to each other share a call.
+    :param t0: start timestamp
+    :param covered: sorted (start, stop) ranges already covered, e.g. the intervals of the station
+    :param gap: uncovered ranges at most this long are ignored, unless they start at t0, defaults to
+    settings.merge_gap, the longest gap the maintenance considers as touching
+    :return: the start timestamps of the timetables to download, at most download_concurrency of them
+    """
+    gap = settings.merge_gap if gap is None else gap
+    window = settings.t_window * 3600
+    t_end = t0 + settings.download_concurrency * window
+    uncovered, t = [], t0  # the uncovered ranges [start, stop) of [t0, t_end), t being the first time not covered
+    for start, stop in covered:
+        if stop < t:
+            continue
+        if start >= t_end:
+            break
+        if start - t > gap or t == t0 < start:  # t0 itself is always loaded
+            uncovered.append((t, start))
+        t = max(t, stop + 1)
+    if t_end - t > gap:
+        uncovered.append((t, t_end))
+    res = []
+    for start, stop in uncovered:
+        if res and start < res[-1] + window:  # partly covered by the previous call
+            start = res[-1] + window
+        while stop - start > gap or start == t0:
+            res.append(start)
+            start += window
+    return res
+
+
+def has_touching_ranges(t0: int, covered: Iterable[Tuple[int, int]], gap: int = None) -> bool:
+    """
+    Check whether separate covered ranges touch each other within [t0, t0 + download_concurrency * t_window), i.e. are
+    at most gap apart. plan_windows downloads nothing between them, so they are only joined by merging the intervals.
+    :param t0: start timestamp
+    :param covered: sorted (start, stop) ranges already covered, e.g. the intervals of the station
+    :param gap: largest gap between two touching ranges, defaults to settings.merge_gap
+    :return: whether some ranges touch
+    """
+    gap = settings.merge_gap if gap is None else gap
+    t_end = t0 + settings.download_concurrency * settings.t_window * 3600
+    last_stop = None
+    for start, stop in covered:
+        if stop < t0:
+            continue
+        if start >= t_end:
+            break
+        if last_stop is not None and start - last_stop <= gap:
+            return True
+        last_stop = stop
+    return False
+
+
+def dump_timetable(json_obj: dict, file_path: str) -> str:
+    """
+    Save a downloaded timetable in a json file
+    :param json_obj: the timetable received from the Transport API
     :param file_path: path of the json file to be saved
-    :param client: httpx client
     :return: the path of the file written
     """
-    params = {'app_id': settings.tpt_app_id, 'app_key': settings.tpt_app_key, 'date': date_str, 'time': time_str}
-    res = await client.get(f'{settings.tpt_url}/{station}/timetable.json', params=params)
     with open(file_path, 'w') as f:
-        json.dump(res.json, f)
+        json.dump(json_obj, f)
     return file_path
 
 
-async def download_multiple_timetables(station: str, t0: int, dir_name: str) -> List[str]:
+async def fetch_timetable(station: str, date_str: str, time_str: str,
+                          client: TransportApiClient = tpt_client) -> dict:
     """
-    Download multiple timetables. The number to download is determined by the concurrency settings
+    Download timetable data using Transport API
     :param station: station code
-    :param t0: start timestamp
-    :param dir_name: the path of the folder for storing the downloaded data
-    :return: a list of files downloaded
+    :param date_str: date in string format e.g. '2022-02-09'
+    :param time_str: time in string format e.g. '14:17'
+    :param client: Transport API client
+    :return: the timetable json object
     """
-    download_tasks = []
-    async with httpx.AsyncClient() as client:
-        for i in range(settings.download_concurrency):
-            file_path = os.path.join(dir_name, f'ttp{i}.json')
-            dt = datetime.fromtimestamp(t0 + i * settings.t_window, pytz.timezone(settings.tz))
-            download_tasks.append(download_timetable(station, dt.strftime('%Y-%m-%d'), dt.strftime('%H:%M'), file_path, client))
-        files = await gather(*download_tasks)
-    return files
-
+    params = {'app_id': settings.tpt_app_id, 'app_key': settings.tpt_app_key, 'date': date_str, 'time': time_str}
+    json_obj = await client.get_json(f'{settings.tpt_url}/{station}/timetable.json', params)
+    if settings.archive_dir:  # keep a copy of the raw response for debugging/archiving
+        os.makedirs(settings.archive_dir, exist_ok=True)
+        dump_timetable(json_obj, os.path.join(settings.archive_dir,
+                                              f'{station}_{date_str}_{time_str.replace(":", "")}.json'))
+    return json_obj
 
 
+async def stream_timetables(station: str, t0: int, starts: List[int] = None) -> AsyncIterator[dict]:
+    """
+    Download multiple timetables concurrently, and yield each of them as soon as it arrives
+    :param station: station code
+    :param t0: start timestamp
+    :param starts: start timestamps of the timetables, defaults to window_starts(t0)
+    :return: an async iterator of timetable json objects, in the order of arrival
+    """
+    tasks = [ensure_future(fetch_timetable(station, dt.strftime('%Y-%m-%d'), dt.strftime('%H:%M')))
+             for dt in window_datetimes(t0, starts)]
+    try:
+        for task in as_completed(tasks):
+            yield await task
+    finally:  # the consumer stopped early or a download failed
+        for task in tasks:
+            task.cancel()